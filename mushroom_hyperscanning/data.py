@@ -1,47 +1,493 @@
+import json
 import os
-from os.path import dirname, join
+import warnings
+from datetime import datetime
+from os.path import dirname, join, relpath, splitext
 from pathlib import Path
-from typing import Tuple
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import mne
 import numpy as np
+from mne._fiff.utils import _mult_cal_one
 from mne_bids import BIDSPath
+from numpy.lib.recfunctions import structured_to_unstructured
 from pydub import AudioSegment
 
+from mushroom_hyperscanning.utils import (
+    INDEX_FILE,
+    INDEX_LOCK_FILE,
+    cached_decode,
+    file_lock,
+    replace_file,
+    window_view,
+)
+
 CH_TYPE_MAPPING = {"CM": "misc", "ECG": "ecg", "Ax": "misc", "Ay": "misc", "Az": "misc"}
+EEG_FORMATS = ("edf", "npy")
+
+# in-memory copies of the EEG indexes, keyed by root directory, with the modification time of the index file
+_indexes: Dict[str, Tuple[Optional[int], Dict[str, Dict[str, Any]]]] = {}
+
+
+class RawNpy(mne.io.BaseRaw):
+    """
+    Raw object backed by a float32 `.npy` file of shape (n_channels, n_times) and a `<fname>.json` sidecar holding the
+    measurement info and annotations. The samples are memory-mapped, so opening the file is instant and reading a
+    channel or time range only touches the corresponding bytes.
+
+    Args:
+        fname (str): Path to the `.npy` file.
+        preload (bool): Whether to preload the data into memory.
+    """
+
+    def __init__(self, fname: str, preload: bool = False):
+        fname = str(fname)
+        with open(fname + ".json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+
+        info = mne.create_info(meta["ch_names"], meta["sfreq"], meta["ch_types"])
+        with info._unlock():
+            info["highpass"], info["lowpass"] = meta["highpass"], meta["lowpass"]
+            if meta["meas_date"] is not None:
+                info["meas_date"] = datetime.fromisoformat(meta["meas_date"])
+        info["bads"] = meta["bads"]
+
+        super().__init__(
+            info, preload, last_samps=[meta["n_times"] - 1], filenames=[fname], orig_format="single", verbose=False
+        )
+        self.set_annotations(mne.Annotations(**meta["annotations"], orig_time=None))
+
+    def _read_segment_file(self, data, idx, fi, start, stop, cals, mult):
+        samples = np.load(self.filenames[fi], mmap_mode="r")
+        # only read the requested channels and samples from the memory map
+        block = samples[idx, start : start + data.shape[1]]
+        _mult_cal_one(data, block, slice(None), cals, mult)
+
+
+def read_eeg(fname: str, preload: bool = False) -> mne.io.BaseRaw:
+    """
+    Read an EEG recording stored as EDF or as memory-mapped `.npy` (see `RawNpy`).
+
+    Args:
+        fname (str): Path to the recording.
+        preload (bool): Whether to preload the data into memory.
+    Returns:
+        mne.io.Raw: The loaded recording.
+    """
+    if str(fname).endswith(".npy"):
+        return RawNpy(fname, preload=preload)
+    return mne.io.read_raw(fname, preload=preload)
+
+
+def write_eeg(fname: str, raw: mne.io.BaseRaw, block_seconds: float = 600.0) -> None:
+    """
+    Write an EEG recording as EDF or as float32 `.npy` with a JSON sidecar, depending on the extension of `fname`.
+    Existing files are replaced instead of overwritten, so hardlinked copies in other derivatives stay untouched.
+
+    Args:
+        fname (str): Output path ending in `.edf` or `.npy`.
+        raw (mne.io.Raw): The recording to save.
+        block_seconds (float): Duration of the blocks copied at once when writing `.npy` files from a raw that isn't
+            preloaded.
+    """
+    fname = str(fname)
+    if not fname.endswith(".npy"):
+        with replace_file(fname) as tmp_path:
+            mne.export.export_raw(tmp_path, raw, physical_range="channelwise", overwrite=True)
+        return
+
+    # stream the samples into the memory map block by block, without a float64 copy of the whole recording
+    block = max(1, int(block_seconds * raw.info["sfreq"]))
+    with replace_file(fname) as tmp_path:
+        out = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.float32, shape=(len(raw.ch_names), int(raw.n_times))
+        )
+        for start in range(0, raw.n_times, block):
+            out[:, start : start + block] = raw.get_data(start=start, stop=start + block)
+        out.flush()
+        del out
+
+    # annotations are stored relative to the first sample
+    annot = raw.annotations
+    onset = annot.onset - raw.first_time if annot.orig_time is not None else annot.onset
+    meas_date = raw.info["meas_date"]
+    meta = {
+        "sfreq": float(raw.info["sfreq"]),
+        "n_times": int(raw.n_times),
+        "ch_names": raw.ch_names,
+        "ch_types": raw.get_channel_types(),
+        "bads": raw.info["bads"],
+        "highpass": float(raw.info["highpass"]),
+        "lowpass": float(raw.info["lowpass"]),
+        "meas_date": None if meas_date is None else meas_date.isoformat(),
+        "annotations": {
+            "onset": onset.tolist(),
+            "duration": annot.duration.tolist(),
+            "description": annot.description.tolist(),
+            "ch_names": [list(ch_names) for ch_names in annot.ch_names],
+        },
+    }
+    with replace_file(fname + ".json") as tmp_path, open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+
+def remove_eeg(fname: str) -> None:
+    """
+    Remove an EEG recording, including the JSON sidecar of `.npy` recordings.
+    """
+    fname = str(fname)
+    os.remove(fname)
+    if fname.endswith(".npy") and os.path.exists(fname + ".json"):
+        os.remove(fname + ".json")
+
+
+def write_reject_log(fname: str, labels: np.ndarray, onsets: np.ndarray, ch_names: List[str]) -> None:
+    """
+    Write a reject log as a single `.npy` file holding one record per epoch: the onset sample of the epoch and one int8
+    label per channel, in a field named after the channel. The file can be memory-mapped by `read_reject_log` without
+    unpickling a `RejectLog` or reading the epochs.
+
+    Args:
+        fname (str): Output path ending in `.npy`.
+        labels (np.ndarray): Labels of shape (n_epochs, n_channels), 0 (good), 1 (bad), 2 (interpolated) or NaN (not
+            evaluated), which is stored as -1.
+        onsets (np.ndarray): Onset sample of each epoch, as in the first column of `epochs.events`.
+        ch_names (List[str]): Name of each channel.
+    """
+    labels = np.asarray(labels, dtype=float)
+    dtype = np.dtype([("onset", np.int64), ("labels", [(ch, np.int8) for ch in ch_names])])
+    log = np.zeros(len(labels), dtype=dtype)
+    log["onset"] = onsets
+    log_labels = structured_to_unstructured(log["labels"])
+    log_labels[:] = np.nan_to_num(labels, nan=-1)
+    with replace_file(str(fname)) as tmp_path:
+        np.save(tmp_path, log)
+
+
+def read_reject_log(fname: str) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+    """
+    Memory-map a reject log written by `write_reject_log`.
+
+    Args:
+        fname (str): Path to the `.npy` file.
+    Returns:
+        Tuple[np.ndarray, np.ndarray, List[str]]: The int8 labels of shape (n_epochs, n_channels) with -1 for channels
+            that were not evaluated, the onset sample of each epoch and the channel names.
+    """
+    log = np.load(fname, mmap_mode="r")
+    if log.dtype.names != ("onset", "labels"):
+        raise ValueError(f"{fname} is not a reject log written by write_reject_log, rerun the rejection step")
+    labels = structured_to_unstructured(log["labels"])
+    return labels, log["onset"], list(log.dtype["labels"].names)
+
+
+def write_epoch_patches(fname: str, epochs: mne.BaseEpochs, raw: mne.io.BaseRaw, chunk_size: int = 500) -> None:
+    """
+    Write the channels of fixed-length epochs that differ from the recording they were cut from, e.g. channels
+    interpolated by AutoReject, as a single `.npy` file holding one record per patched channel: the onset sample of the
+    epoch, the index of the channel and its float32 samples. Together with the recording and the onsets of the epochs,
+    this is all `LazyEpochs` needs to reconstruct the epochs without storing them.
+
+    Args:
+        fname (str): Output path ending in `.npy`.
+        epochs (mne.BaseEpochs): Preloaded epochs starting at their events, with the channels of `raw`.
+        raw (mne.io.Raw): The recording the epochs were cut from.
+        chunk_size (int): Number of epochs compared at once, bounding the memory use.
+    """
+    n_times = len(epochs.times)
+    starts = epochs.events[:, 0] - raw.first_samp
+    onsets, channels, patches = [], [], []
+    for i in range(0, len(epochs), chunk_size):
+        chunk = slice(i, i + chunk_size)
+        # read the recording once for the whole chunk and compare every epoch with its view into it
+        first, last = starts[chunk][0], starts[chunk][-1]
+        segment = raw.get_data(start=first, stop=last + n_times)
+        original = window_view(segment, n_times, 1, last - first + 1)[starts[chunk] - first]
+        data = epochs.get_data(item=chunk, copy=False)
+        epoch, channel = np.nonzero(np.any(data != original, axis=-1))
+        onsets.append(epochs.events[chunk, 0][epoch])
+        channels.append(channel)
+        patches.append(data[epoch, channel])
+
+    dtype = np.dtype([("onset", np.int64), ("channel", np.int32), ("data", np.float32, (n_times,))])
+    log = np.zeros(sum(len(c) for c in channels), dtype=dtype)
+    if len(log) > 0:
+        log["onset"], log["channel"], log["data"] = (
+            np.concatenate(onsets),
+            np.concatenate(channels),
+            np.concatenate(patches),
+        )
+    with replace_file(str(fname)) as tmp_path:
+        np.save(tmp_path, log)
 
 
-def load_eeg(sub: str, ceremony: str, root: str, preload: bool = False) -> mne.io.BaseRaw:
+class LazyEpochs(mne.Epochs):
     """
-    Load EEG data for a given subject and ceremony from the BIDS dataset.
+    Fixed-length epochs of a recording that are only read from it when their data is requested, with the channel
+    patches written by `write_epoch_patches` applied on top. For memory-mapped `.npy` recordings (see `RawNpy`), reading
+    an epoch only touches its samples, so the epochs don't need to be stored next to the recording.
+
+    Args:
+        raw (mne.io.Raw): The recording the epochs were cut from, not preloaded.
+        onsets (np.ndarray): Onset sample of each epoch.
+        patches_fname (str): Path to the patches written by `write_epoch_patches`, sorted by onset. Their sample count
+            sets the length of the epochs. The file is memory-mapped and only the patches of the epochs that are read
+            are loaded.
+        preload (bool): Whether to read all epochs into memory.
+    """
+
+    def __init__(self, raw: mne.io.BaseRaw, onsets: np.ndarray, patches_fname: str, preload: bool = False):
+        patches = np.load(patches_fname, mmap_mode="r")
+        # keep the onsets of the patches to look them up, the memory map itself is reopened for every epoch so copies
+        # of the epochs don't copy the patches into memory
+        self._patches_fname = str(patches_fname)
+        self._patch_onsets = np.array(patches["onset"])
+        if not np.all(np.diff(self._patch_onsets) >= 0):
+            raise ValueError("The patches must be sorted by onset, as written by write_epoch_patches")
+        n_times = patches.dtype["data"].shape[0]
+        events = np.zeros((len(onsets), 3), dtype=int)
+        events[:, 0], events[:, 2] = onsets, 1
+        # same events and timing as mne.make_fixed_length_epochs
+        super().__init__(
+            raw,
+            events,
+            event_id=[1],
+            tmin=0,
+            tmax=(n_times - 1) / raw.info["sfreq"],
+            baseline=None,
+            preload=preload,
+            reject_by_annotation=False,
+            proj=False,
+            verbose=False,
+        )
+        # without rejection criteria, this only checks that the epochs lie within the recording and reads no data
+        self.drop_bad()
+
+    def _get_epoch_from_raw(self, idx, verbose=None):
+        data = super()._get_epoch_from_raw(idx, verbose)
+
+        # position of every recording channel among the picked channels, -1 if it isn't picked
+        positions = np.full(len(self._raw.ch_names), -1)
+        positions[self.picks] = np.arange(len(self.picks))
+        onset = self.events[idx, 0]
+        lo, hi = np.searchsorted(self._patch_onsets, [onset, onset + 1])
+        if lo == hi:
+            return data
+        # only the patches of this epoch are read from the memory map
+        patches = np.load(self._patches_fname, mmap_mode="r")[lo:hi]
+        rows = positions[patches["channel"]]
+        data[rows[rows >= 0]] = patches["data"][rows >= 0]
+        return data
+
+
+def load_epochs(sub: str, ceremony: str, root: str, preload: bool = False) -> LazyEpochs:
+    """
+    Load the cleaned 1-second epochs of a subject and ceremony, reconstructed from the EEG recording, the onsets of the
+    reject log (see `write_reject_log`) and the channel patches of the epochs (see `write_epoch_patches`).
+
+    Args:
+        sub (str): Subject identifier.
+        ceremony (str): Ceremony identifier.
+        root (str): Root directory of the BIDS dataset.
+        preload (bool): Whether to read all epochs into memory.
+    Returns:
+        LazyEpochs: The epochs, read from the recording when their data is requested unless `preload` is True.
+    """
+    raw = load_eeg(sub, ceremony, root)
+    basepath = str(raw.filenames[0]).rsplit("_eeg.", 1)[0]
+    _, onsets, _ = read_reject_log(basepath + "_rejectlog.npy")
+    return LazyEpochs(raw, onsets, basepath + "_patches.npy", preload=preload)
+
+
+def _read_index(root: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Read the EEG index of a dataset, reusing the in-memory copy as long as the index file didn't change.
+    """
+    fname = join(root, INDEX_FILE)
+    mtime = os.stat(fname).st_mtime_ns if os.path.exists(fname) else None
+    if root in _indexes and _indexes[root][0] == mtime:
+        return _indexes[root][1]
+
+    index = _load_index_file(fname) if mtime is not None else {}
+    _indexes[root] = (mtime, index)
+    return index
+
+
+def _load_index_file(fname: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Read an EEG index file, unreadable indexes are rebuilt from scratch.
+    """
+    try:
+        with open(fname, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_index(root: str, key: str, entry: Dict[str, Any]) -> None:
+    """
+    Persist the entry `key` of the EEG index of a dataset. The entry is merged into the index file while holding a
+    lock, so workers saving recordings of the same dataset in parallel don't drop each other's entries. Datasets that
+    can't be written, e.g. read-only source datasets, are left without an index.
+    """
+    fname = join(root, INDEX_FILE)
+    try:
+        with file_lock(join(root, INDEX_LOCK_FILE)):
+            # merge into the current index file, which other processes may have updated since it was read
+            merged = _load_index_file(fname) if os.path.exists(fname) else {}
+            merged[key] = entry
+            with replace_file(fname) as tmp_path, open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(merged, f)
+            _indexes[root] = (os.stat(fname).st_mtime_ns, merged)
+    except OSError as e:
+        warnings.warn(f"Couldn't write the EEG index of {root}: {e}")
+
+
+def _index_entry(sub: str, ceremony: str, root: str) -> Dict[str, Any]:
+    """
+    Look up the EEG recording of a subject and ceremony in the index of `root`. Entries are invalidated when the size
+    or modification time of the file changes, and missing or removed files are looked up again with `BIDSPath.match`.
+    """
+    index = _read_index(root)
+    key = f"sub-{sub}_ses-{ceremony}"
+    entry = index.get(key)
+    if entry is not None:
+        try:
+            stat = os.stat(join(root, entry["path"]))
+        except FileNotFoundError:
+            entry = None
+        else:
+            if (stat.st_size, stat.st_mtime_ns) != (entry["size"], entry["mtime_ns"]):
+                # the file was rewritten, drop its metadata
+                entry = index[key] = {"path": entry["path"], "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+                _write_index(root, key, entry)
+
+    if entry is None:
+        paths = BIDSPath(subject=sub, session=ceremony, task="psilo", datatype="eeg", root=root).match()
+        if len(paths) == 0:
+            raise FileNotFoundError(f"No EEG data found for subject {sub} in ceremony {ceremony}.")
+        fname = str(paths[0].fpath)
+        stat = os.stat(fname)
+        entry = index[key] = {
+            "path": Path(relpath(fname, root)).as_posix(),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+        _write_index(root, key, entry)
+    return entry
+
+
+def _index_metadata(key: str, entry: Dict[str, Any], raw: mne.io.BaseRaw, root: str) -> None:
+    """
+    Store the metadata of a freshly read or written recording in its index entry `key`.
+    """
+    # annotations are stored relative to the first sample
+    annot = raw.annotations
+    onset = annot.onset - raw.first_time if annot.orig_time is not None else annot.onset
+    meas_date = raw.info["meas_date"]
+    entry.update(
+        sfreq=float(raw.info["sfreq"]),
+        n_times=int(raw.n_times),
+        ch_names=list(raw.ch_names),
+        meas_date=None if meas_date is None else meas_date.isoformat(),
+        annotations={
+            "onset": onset.tolist(),
+            "duration": annot.duration.tolist(),
+            "description": annot.description.tolist(),
+        },
+    )
+    _write_index(root, key, entry)
+
+
+def _indexed_metadata(sub: str, ceremony: str, root: str) -> Dict[str, Any]:
+    """
+    Get the index entry of a recording, reading the header of the recording if the entry has no metadata yet.
+    """
+    entry = _index_entry(sub, ceremony, root)
+    if "sfreq" not in entry:
+        _index_metadata(f"sub-{sub}_ses-{ceremony}", entry, read_eeg(join(root, entry["path"])), root)
+    return entry
+
+
+def eeg_metadata(sub: str, ceremony: str, root: str) -> Dict[str, Any]:
+    """
+    Get the metadata of the EEG recording of a subject and ceremony from the index of the dataset, without opening the
+    recording unless the index is out of date.
+
+    Args:
+        sub (str): Subject identifier.
+        ceremony (str): Ceremony identifier.
+        root (str): Root directory of the BIDS dataset.
+    Returns:
+        dict: Path of the recording, sampling frequency (`sfreq`), number of samples (`n_times`), channel names
+            (`ch_names`), measurement date (`meas_date`, ISO format) and number of annotations per description
+            (`annotations`).
+    """
+    if not Path(root).exists():
+        raise FileNotFoundError(f"Couldn't find the root folder: {root}")
+    root = os.path.abspath(root)
+    entry = _indexed_metadata(sub, ceremony, root)
+    metadata = {key: value for key, value in entry.items() if key not in ("size", "mtime_ns", "annotations")}
+    metadata["path"] = join(root, entry["path"])
+    descriptions, counts = np.unique(entry["annotations"]["description"], return_counts=True)
+    metadata["annotations"] = {str(d): int(c) for d, c in zip(descriptions, counts)}
+    return metadata
+
+
+def load_eeg(
+    sub: str,
+    ceremony: str,
+    root: str,
+    preload: bool = False,
+    picks: Optional[Union[str, List[str]]] = None,
+    tmin: Optional[float] = None,
+    tmax: Optional[float] = None,
+    annotations_only: bool = False,
+) -> Union[mne.io.BaseRaw, mne.Annotations]:
+    """
+    Load EEG data for a given subject and ceremony from the BIDS dataset. Channel and time selections are applied
+    before the data is read, so only the requested channels and samples are loaded.
 
     Args:
         sub (str): Subject identifier.
         ceremony (str): Ceremony identifier.
         root (str): Root directory of the BIDS dataset.
         preload (bool): Whether to preload the data into memory.
+        picks (str | List[str] | None): Channel names or types to load (e.g. "eeg", ["ECG"]). Loads all channels if None.
+        tmin (float | None): Start of the time range to load in seconds. Defaults to the start of the recording.
+        tmax (float | None): End of the time range to load in seconds (included). Defaults to the end of the recording.
+        annotations_only (bool): Whether to only return the annotations of the recording. They are read from the index
+            of the dataset without opening the recording (see `eeg_metadata`).
     Returns:
-        mne.io.Raw: The loaded EEG data.
+        mne.io.Raw | mne.Annotations: The loaded EEG data, or its annotations if `annotations_only` is True.
     """
     if not Path(root).exists():
         raise FileNotFoundError(f"Couldn't find the root folder: {root}")
-    paths = BIDSPath(
-        subject=sub,
-        session=ceremony,
-        task="psilo",
-        datatype="eeg",
-        root=root,
-    ).match()
+    # look the file up in the index of the dataset instead of matching the whole BIDS tree
+    root = os.path.abspath(root)
+    if annotations_only:
+        entry = _indexed_metadata(sub, ceremony, root)
+        meas_date = None if entry["meas_date"] is None else datetime.fromisoformat(entry["meas_date"])
+        return mne.Annotations(**entry["annotations"], orig_time=meas_date)
 
-    if len(paths) == 0:
-        raise FileNotFoundError(f"No EEG data found for subject {sub} in ceremony {ceremony}.")
-    raw = mne.io.read_raw(paths[0], preload=preload)
+    entry = _index_entry(sub, ceremony, root)
+    raw = read_eeg(join(root, entry["path"]))
+    if "sfreq" not in entry:
+        _index_metadata(f"sub-{sub}_ses-{ceremony}", entry, raw, root)
     raw.info.set_channel_types({ch: CH_TYPE_MAPPING[ch] if ch in CH_TYPE_MAPPING else "eeg" for ch in raw.ch_names})
+
+    # select channels and samples before reading the data
+    if picks is not None:
+        raw.pick(picks)
+    if tmin is not None or tmax is not None:
+        raw.crop(tmin=0.0 if tmin is None else tmin, tmax=tmax)
     raw.set_montage(mne.channels.make_standard_montage("standard_1020"))
+    if preload:
+        raw.load_data()
     return raw
 
 
-def save_eeg(raw: mne.io.Raw, sub: str, ceremony: str, root: str) -> None:
+def save_eeg(raw: mne.io.Raw, sub: str, ceremony: str, root: str, fmt: Optional[str] = None) -> None:
     """
     Save EEG data to the BIDS format.
 
@@ -50,38 +496,86 @@ def save_eeg(raw: mne.io.Raw, sub: str, ceremony: str, root: str) -> None:
         sub (str): Subject identifier.
         ceremony (str): Ceremony identifier.
         root (str): Root directory of the BIDS dataset.
+        fmt (str | None): Storage format, either "edf" or "npy" (float32 samples memory-mapped by `load_eeg`, see
+            `RawNpy`). If None, the format of the existing recording is kept, defaulting to "edf".
     """
-    bids_path = str(
-        BIDSPath(
-            subject=sub,
-            session=ceremony,
-            task="psilo",
-            datatype="eeg",
-            root=root,
-        )
+    root = os.path.abspath(root)
+    path = BIDSPath(
+        subject=sub,
+        session=ceremony,
+        task="psilo",
+        datatype="eeg",
+        root=root,
     )
+    existing = []
+    if Path(root).exists():
+        try:
+            existing = [join(root, _index_entry(sub, ceremony, root)["path"])]
+        except FileNotFoundError:
+            pass
+    existing = [fname for fname in existing if splitext(fname)[1][1:] in EEG_FORMATS]
+    if fmt is None:
+        fmt = splitext(existing[0])[1][1:] if len(existing) > 0 else "edf"
+    if fmt not in EEG_FORMATS:
+        raise ValueError(f"Unknown EEG format {fmt}, expected one of {EEG_FORMATS}.")
 
+    bids_path = join(str(path.directory), f"{path.basename}_eeg.{fmt}")
     os.makedirs(dirname(bids_path), exist_ok=True)
-    if "_eeg" not in bids_path:
-        bids_path = bids_path + "_eeg"
-    if not bids_path.endswith(".edf"):
-        bids_path = bids_path + ".edf"
-    mne.export.export_raw(bids_path, raw, physical_range="channelwise", overwrite=True)
+    write_eeg(bids_path, raw)
 
+    # remove the recording in the other format so each subject and ceremony has a single EEG file
+    for fname in existing:
+        if fname != bids_path:
+            remove_eeg(fname)
 
-def load_audio(ceremony: str, root: str) -> Tuple[np.ndarray, int]:
+    # index the new file with the metadata of the saved recording
+    stat = os.stat(bids_path)
+    key = f"sub-{sub}_ses-{ceremony}"
+    entry = _read_index(root)[key] = {
+        "path": Path(relpath(bids_path, root)).as_posix(),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+    _index_metadata(key, entry, raw, root)
+
+
+def _decode_audio(path: str, out_path: str) -> Dict[str, int]:
+    """
+    Decode an audio file into a `.npy` array of (interleaved) samples, see `cached_decode`.
+    """
+    audio = AudioSegment.from_file(path)
+    np.save(out_path, np.array(audio.get_array_of_samples()))
+    return {"frame_rate": audio.frame_rate, "channels": audio.channels}
+
+
+def load_audio(
+    ceremony: str, root: str, tmin: Optional[float] = None, tmax: Optional[float] = None, cache: bool = True
+) -> Tuple[np.ndarray, int]:
     """
     Load audio data for a given ceremony from the BIDS dataset.
 
+    The mp3 is decoded only once: the decoded samples are cached in `<root>/../.cache/audio`, keyed by the hash of the
+    mp3, and memory-mapped on later calls, so reading a time range only touches the corresponding samples.
+
     Args:
         ceremony (str): Ceremony identifier.
         root (str): Root directory of the BIDS dataset.
+        tmin (float | None): Start of the time range to load in seconds. Defaults to the start of the recording.
+        tmax (float | None): End of the time range to load in seconds. Defaults to the end of the recording.
+        cache (bool): Whether to use the decoded-audio cache. If False, the mp3 is decoded in memory.
     Returns:
-        tuple: A tuple containing the audio data as a NumPy array and the sample rate.
+        tuple: A tuple containing the audio data as a NumPy array (interleaved samples for multichannel audio, read-only
+            if loaded from the cache) and the sample rate.
     """
     path = join(root, "audio", f"ses-{ceremony}", f"audio_ses-{ceremony}_task-psilo_audio.mp3")
 
-    audio = AudioSegment.from_mp3(path)
-    srate = audio.frame_rate
-    audio = np.array(audio.get_array_of_samples())
-    return audio, srate
+    if cache:
+        audio, meta = cached_decode(path, join(dirname(os.path.abspath(root)), ".cache", "audio"), "pcm", _decode_audio)
+        srate, channels = meta["frame_rate"], meta["channels"]
+    else:
+        segment = AudioSegment.from_mp3(path)
+        audio, srate, channels = np.array(segment.get_array_of_samples()), segment.frame_rate, segment.channels
+
+    start = 0 if tmin is None else int(round(tmin * srate)) * channels
+    stop = len(audio) if tmax is None else int(round(tmax * srate)) * channels
+    return audio[start:stop], srate
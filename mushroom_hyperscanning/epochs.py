@@ -1,8 +1,12 @@
+from collections.abc import Mapping
+
 import mne
 import numpy as np
 from matplotlib import pyplot as plt
 from matplotlib.ticker import FuncFormatter
 
+from mushroom_hyperscanning.data import load_epochs, read_reject_log
+
 
 def extract_coherent_epochs(
     subj, ceremony, root, window_length, overlap=0.0, include_interpolated=True, max_bad_channels=0
@@ -33,11 +37,172 @@ def extract_coherent_epochs(
     new_epochs : mne.Epochs
         New epochs object with specified window length containing only coherent chunks
     """
-    # Load data
+    sweep = sweep_coherent_epochs(
+        subj,
+        ceremony,
+        root,
+        [window_length],
+        [overlap],
+        include_interpolated=include_interpolated,
+        max_bad_channels=max_bad_channels,
+    )
+    return sweep[window_length, overlap]
+
+
+def sweep_coherent_epochs(
+    subj, ceremony, root, window_lengths, overlaps=(0.0,), include_interpolated=True, max_bad_channels=0
+):
+    """
+    Extract coherent chunks of data for several window lengths and overlaps at once.
+
+    The valid epochs are determined once for all window lengths and overlaps from the reject log alone, without reading
+    the epochs data. Epochs are placed by their onset sample (see `epoch_grid`), so missing epochs break a chunk. The
+    windows of each combination are only stitched together when it is accessed, so scanning over many combinations
+    doesn't hold all of them in memory.
+
+    Parameters
+    ----------
+    subj : int
+        Subject number
+    ceremony : str
+        Ceremony name (e.g., 'ceremony1')
+    root : str
+        Root path to the data directory
+    window_lengths : list of float
+        Lengths of the output epochs in seconds
+    overlaps : list of float, optional
+        Overlaps between consecutive windows in seconds, combined with every window length (default: (0.0,))
+    include_interpolated : bool, optional
+        If True, include epochs with interpolated channels (reject value 2).
+        If False, only include good epochs (reject value 0). Default: True
+    max_bad_channels : int, optional
+        Maximum number of bad channels allowed per epoch (default: 0)
+
+    Returns
+    -------
+    sweep : CoherentEpochsSweep
+        Mapping from (window_length, overlap) to the epochs of that combination, see `extract_coherent_epochs`
+    """
+    epochs, reject, onsets = load_subject_epochs(subj, ceremony, root)
+    valid_epochs, index = epoch_grid(
+        onsets, valid_epoch_mask(reject, include_interpolated, max_bad_channels), len(epochs.times)
+    )
+    return CoherentEpochsSweep(epochs, valid_epochs, window_lengths, overlaps, index=index)
+
+
+def extract_joint_coherent_epochs(
+    subjs, ceremony, root, window_length, overlap=0.0, include_interpolated=True, max_bad_channels=0
+):
+    """
+    Extract coherent chunks of data that are clean for both subjects of a dyad.
+
+    The 1-second epochs of both subjects are matched by their onset sample, and an epoch is only valid if it is valid
+    for both subjects. The chunks are searched in this joint validity mask, so every chunk is kept for both subjects,
+    and missing epochs of either subject break a chunk.
+
+    Parameters
+    ----------
+    subjs : tuple of int
+        Subject numbers of the dyad
+    ceremony : str
+        Ceremony name (e.g., 'ceremony1')
+    root : str
+        Root path to the data directory
+    window_length : float
+        Length of the output epochs in seconds
+    overlap : float, optional
+        Overlap between consecutive windows in seconds (default: 0.0)
+    include_interpolated : bool, optional
+        If True, include epochs with interpolated channels (reject value 2).
+        If False, only include good epochs (reject value 0). Default: True
+    max_bad_channels : int, optional
+        Maximum number of bad channels allowed per epoch and subject (default: 0)
+
+    Returns
+    -------
+    new_epochs1, new_epochs2 : mne.Epochs
+        Epochs of both subjects with the same onsets, the i-th epoch of one subject matches the i-th epoch of the other
+    """
+    subj1, subj2 = subjs
+    epochs1, reject1, onsets1 = load_subject_epochs(subj1, ceremony, root)
+    epochs2, reject2, onsets2 = load_subject_epochs(subj2, ceremony, root)
+    if epochs1.info["sfreq"] != epochs2.info["sfreq"] or len(epochs1.times) != len(epochs2.times):
+        raise ValueError("The epochs of both subjects must have the same sampling frequency and duration")
+
+    # match the epochs of both subjects by their integer onset sample
+    onsets, index1, index2 = np.intersect1d(onsets1, onsets2, return_indices=True)
+    valid = valid_epoch_mask(reject1[index1], include_interpolated, max_bad_channels) & valid_epoch_mask(
+        reject2[index2], include_interpolated, max_bad_channels
+    )
+
+    # place the common epochs on the grid of consecutive epochs, and look up the epoch of each subject in every slot
+    valid_epochs, index = epoch_grid(onsets, valid, len(epochs1.times))
+    lookup1, lookup2 = index1[index], index2[index]
+
+    n_epochs_per_window, step_size = window_epochs(epochs1, window_length, overlap)
+    starts = coherent_window_starts(valid_epochs, n_epochs_per_window, step_size)
+    if len(starts) == 0:
+        print(f"Warning: No coherent chunks of length {window_length}s found!")
+        # Return empty epochs objects
+        return epochs1[0:0], epochs2[0:0]
+
+    print(f"Found {len(starts)} joint coherent chunks of {window_length}s (from {len(onsets)} common 1s epochs)")
+    return (
+        coherent_epochs(epochs1, starts, n_epochs_per_window, lookup1),
+        coherent_epochs(epochs2, starts, n_epochs_per_window, lookup2),
+    )
+
+
+def load_subject_epochs(subj, ceremony, root):
+    """
+    Open the 1-second epochs of a subject without reading their data (see `load_epochs`), and memory-map the labels
+    and onset samples of its reject log (see `write_reject_log`), so the epochs can be selected before any data is read.
+    """
     basepath = f"{root}/sub-{subj:02d}/ses-{ceremony}/eeg/sub-{subj:02d}_ses-{ceremony}_task-psilo_"
-    epochs = mne.read_epochs(basepath + "epochs.fif")
-    reject = np.load(basepath + "rejectlog.npy")
+    reject, onsets, _ = read_reject_log(basepath + "rejectlog.npy")
+    return load_epochs(f"{subj:02d}", ceremony, root), reject, onsets
+
 
+def epoch_grid(onsets, valid_epochs, epoch_samples):
+    """
+    Place epochs on a grid of consecutive epochs by their onset sample, so epochs missing from the reject log (e.g.
+    dropped as flat) are gaps in the validity mask instead of joining their neighbours into one run. Epochs that are
+    not aligned to the grid of the first epoch are left out.
+
+    Parameters
+    ----------
+    onsets : np.ndarray
+        Onset sample of each epoch
+    valid_epochs : np.ndarray
+        Boolean mask of the valid epochs
+    epoch_samples : int
+        Number of samples per epoch
+
+    Returns
+    -------
+    valid_slots : np.ndarray
+        Boolean mask of the valid grid slots, missing epochs are invalid
+    index : np.ndarray
+        Epoch in each grid slot, only meaningful for valid slots
+    """
+    onsets = np.asarray(onsets, dtype=np.int64)
+    if len(onsets) == 0:
+        return np.zeros(0, dtype=bool), np.zeros(0, dtype=int)
+    offsets = onsets - onsets.min()
+    on_grid = np.flatnonzero(offsets % epoch_samples == 0)
+    slots = offsets[on_grid] // epoch_samples
+    valid_slots = np.zeros(slots.max() + 1, dtype=bool)
+    valid_slots[slots] = np.asarray(valid_epochs)[on_grid]
+    index = np.zeros(len(valid_slots), dtype=int)
+    index[slots] = on_grid
+    return valid_slots, index
+
+
+def window_epochs(epochs, window_length, overlap=0.0):
+    """
+    Number of 1-second epochs per window and number of epochs between consecutive windows, see
+    `extract_coherent_epochs`.
+    """
     # Get epoch duration (should be 1s based on description)
     epoch_duration = epochs.times[-1] - epochs.times[0] + 1 / epochs.info["sfreq"]
 
@@ -45,10 +210,48 @@ def extract_coherent_epochs(
     n_epochs_per_window = int(np.round(window_length / epoch_duration))
 
     # Calculate step size in epochs based on overlap
-    step_size = int(np.round((window_length - overlap) / epoch_duration))
-    if step_size < 1:
-        step_size = 1
+    step_size = max(int(np.round((window_length - overlap) / epoch_duration)), 1)
+    return n_epochs_per_window, step_size
+
 
+def coherent_epochs(epochs, starts, n_epochs_per_window, index=None):
+    """
+    Create epochs of `n_epochs_per_window` consecutive epochs for each window start, see `stitch_epochs`. The windows
+    keep the onset and event code of their first epoch. Only the epochs within the windows are read.
+    """
+    if index is None:
+        index = np.arange(len(epochs))
+    # epochs of each window, and their position among the epochs that are read
+    members = starts[:, None] + np.arange(n_epochs_per_window)
+    needed, positions = np.unique(index[members], return_inverse=True)
+    read_index = np.zeros(len(index), dtype=int)
+    read_index[members] = positions.reshape(members.shape)
+    new_epochs_data = stitch_epochs(epochs.get_data(item=needed), starts, n_epochs_per_window, index=read_index)
+
+    # first epoch of each window
+    first = index[starts]
+
+    # Create event for each new epoch (use time of first epoch in chunk and keep original event code)
+    new_events = np.zeros((len(starts), 3), dtype=epochs.events.dtype)
+    new_events[:, 0] = epochs.events[first, 0]
+    new_events[:, 2] = epochs.events[first, 2]
+
+    # Create new epochs object
+    return mne.EpochsArray(
+        new_epochs_data,
+        epochs.info,
+        events=new_events,
+        tmin=epochs.times[0],
+        event_id=epochs.event_id,
+        verbose=False,
+    )
+
+
+def valid_epoch_mask(reject, include_interpolated=True, max_bad_channels=0):
+    """
+    Mark the epochs with at most `max_bad_channels` bad channels in a reject log of shape (n_epochs, n_channels), see
+    `extract_coherent_epochs`.
+    """
     # Determine valid epochs based on rejection criteria
     if include_interpolated:
         # Count bad channels per epoch (reject value 1 = bad)
@@ -58,54 +261,130 @@ def extract_coherent_epochs(
         bad_channels_per_epoch = np.sum((reject == 1) | (reject == 2), axis=1)
 
     # Mark epochs as valid if they have <= max_bad_channels
-    valid_epochs = bad_channels_per_epoch <= max_bad_channels
-
-    # Find coherent chunks of valid epochs
-    coherent_chunks = []
-    i = 0
-    while i <= len(valid_epochs) - n_epochs_per_window:
-        # Check if we have n_epochs_per_window consecutive valid epochs
-        if np.all(valid_epochs[i : i + n_epochs_per_window]):
-            coherent_chunks.append(list(range(i, i + n_epochs_per_window)))
-            i += step_size
-        else:
-            i += 1
-
-    if len(coherent_chunks) == 0:
-        print(f"Warning: No coherent chunks of length {window_length}s found!")
-        # Return empty epochs object
-        return epochs[0:0]
+    return bad_channels_per_epoch <= max_bad_channels
 
-    print(f"Found {len(coherent_chunks)} coherent chunks of {window_length}s " f"(from {len(epochs)} 1s epochs)")
 
-    # Get all epochs data once (faster than calling get_data in loop)
-    all_epochs_data = epochs.get_data(copy=True)  # shape: (n_epochs, n_channels, n_times)
+class CoherentEpochsSweep(Mapping):
+    """
+    Coherent chunks of 1-second epochs for several window lengths and overlaps, keyed by (window_length, overlap).
 
-    # Stitch together the epochs for each coherent chunk
-    new_epochs_data = []
-    new_events = []
+    The window starts of every combination are found when the sweep is created. The windows themselves are stitched
+    together each time a combination is accessed, reading only the epochs within the windows.
 
-    for chunk_idx, chunk_indices in enumerate(coherent_chunks):
-        # Get data for this chunk and concatenate along time axis
-        chunk_data = all_epochs_data[chunk_indices]  # shape: (n_epochs_in_chunk, n_channels, n_times)
-        stitched_data = chunk_data.reshape(chunk_data.shape[1], -1)  # (n_channels, n_epochs*n_times)
-        new_epochs_data.append(stitched_data)
+    Parameters
+    ----------
+    epochs : mne.Epochs
+        Epochs of equal duration, which don't need to be preloaded
+    valid_epochs : np.ndarray
+        Boolean mask of the epochs that may be part of a window
+    window_lengths : list of float
+        Lengths of the output epochs in seconds
+    overlaps : list of float
+        Overlaps between consecutive windows in seconds
+    index : np.ndarray, optional
+        Epoch at each position of `valid_epochs`, if the mask is laid out on a grid of onsets (see `epoch_grid`)
+    """
 
-        # Create event for this new epoch (use time of first epoch in chunk)
-        first_event = epochs.events[chunk_indices[0]]
-        new_event = [first_event[0], 0, first_event[2]]  # Keep original event code
-        new_events.append(new_event)
+    def __init__(self, epochs, valid_epochs, window_lengths, overlaps=(0.0,), index=None):
+        self.epochs = epochs
+        self.valid_epochs = valid_epochs
+        self.index = index
 
-    # Stack all epochs
-    new_epochs_data = np.array(new_epochs_data)  # (n_new_epochs, n_channels, n_times)
-    new_events = np.array(new_events)
+        # window starts and number of epochs per window for every combination
+        self.windows = {}
+        for window_length in window_lengths:
+            for overlap in overlaps:
+                n_epochs_per_window, step_size = window_epochs(epochs, window_length, overlap)
+                starts = coherent_window_starts(valid_epochs, n_epochs_per_window, step_size)
+                self.windows[window_length, overlap] = (starts, n_epochs_per_window)
 
-    # Create new epochs object
-    new_epochs = mne.EpochsArray(
-        new_epochs_data, epochs.info, events=new_events, tmin=epochs.times[0], event_id=epochs.event_id, verbose=False
-    )
+    def __getitem__(self, key):
+        window_length, _ = key
+        starts, n_epochs_per_window = self.windows[key]
+        epochs = self.epochs
+
+        if len(starts) == 0:
+            print(f"Warning: No coherent chunks of length {window_length}s found!")
+            # Return empty epochs object
+            return epochs[0:0]
+
+        print(f"Found {len(starts)} coherent chunks of {window_length}s " f"(from {len(epochs)} 1s epochs)")
+
+        # Stitch together the epochs of each coherent chunk
+        return coherent_epochs(epochs, starts, n_epochs_per_window, self.index)
+
+    def __iter__(self):
+        return iter(self.windows)
+
+    def __len__(self):
+        return len(self.windows)
+
+
+def coherent_window_starts(valid_epochs, n_epochs_per_window, step_size):
+    """
+    Find the first epoch of every window of consecutive valid epochs.
+
+    Windows are laid out every `step_size` epochs from the start of each run of valid epochs, as long as they fit into
+    the run. The runs are found from the changes of the validity mask, so the cost is linear in the number of epochs
+    and independent of the window length.
+
+    Parameters
+    ----------
+    valid_epochs : np.ndarray
+        Boolean mask of valid epochs
+    n_epochs_per_window : int
+        Number of consecutive epochs per window
+    step_size : int
+        Number of epochs between the starts of consecutive windows within a run
 
-    return new_epochs
+    Returns
+    -------
+    starts : np.ndarray
+        Index of the first epoch of each window, in increasing order
+    """
+    # runs of valid epochs start where the padded mask rises and stop where it falls
+    changes = np.diff(np.concatenate([[0], np.asarray(valid_epochs, dtype=np.int8), [0]]))
+    run_starts, run_stops = np.flatnonzero(changes == 1), np.flatnonzero(changes == -1)
+    lengths = run_stops - run_starts
+    fits = lengths >= n_epochs_per_window
+    run_starts, lengths = run_starts[fits], lengths[fits]
+
+    # number of windows per run, and the position of each window within its run
+    counts = (lengths - n_epochs_per_window) // step_size + 1
+    positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(run_starts, counts) + positions * step_size
+
+
+def stitch_epochs(data, starts, n_epochs_per_window, out=None, index=None):
+    """
+    Concatenate `n_epochs_per_window` consecutive epochs along time for each window start.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Epochs data of shape (n_epochs, n_channels, n_times)
+    starts : np.ndarray
+        Index of the first epoch of each window
+    n_epochs_per_window : int
+        Number of consecutive epochs per window
+    out : np.ndarray, optional
+        Output array of shape (n_windows, n_channels, n_epochs_per_window * n_times), allocated if not provided
+    index : np.ndarray, optional
+        Epoch of `data` at each position, if the windows are laid out on positions other than the epoch indices
+
+    Returns
+    -------
+    out : np.ndarray
+        Stitched windows of shape (n_windows, n_channels, n_epochs_per_window * n_times)
+    """
+    n_channels, n_times = data.shape[1:]
+    if out is None:
+        out = np.empty((len(starts), n_channels, n_epochs_per_window * n_times), dtype=data.dtype)
+    # each window holds its epochs side by side along time, gather the k-th epoch of all windows at once
+    windows = out.reshape(len(starts), n_channels, n_epochs_per_window, n_times)
+    for k in range(n_epochs_per_window):
+        windows[:, :, k] = data[starts + k if index is None else index[starts + k]]
+    return out
 
 
 def find_epoch_intersection(epochs1, epochs2):
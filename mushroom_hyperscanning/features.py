@@ -0,0 +1,49 @@
+from typing import Dict, Optional, Tuple
+
+import mne
+import numpy as np
+
+FREQ_BANDS = {
+    "delta": (0.5, 4.0),
+    "theta": (4.0, 8.0),
+    "alpha": (8.0, 12.0),
+    "beta": (12.0, 30.0),
+    "gamma": (30.0, 45.0),
+}
+# order of the absolute and relative band power along the last axis of `band_power`
+POWER_KINDS = ("absolute", "relative")
+
+
+def band_power(
+    data: np.ndarray,
+    sfreq: float,
+    bands: Optional[Dict[str, Tuple[float, float]]] = None,
+    precision_hz: float = 2.0,
+) -> np.ndarray:
+    """
+    Compute the absolute and relative mean power in several frequency bands for a batch of windows at once. A single
+    Welch PSD is computed over the whole (n_windows, n_channels, n_times) stack and every band is read from it, so
+    sweeping over all bands costs one spectral estimate instead of one per band. The function follows the
+    `func(data, sfreq)` signature of `batched_sliding_window`.
+
+    Args:
+        data (np.ndarray): 3D numpy array of shape (n_windows, n_channels, n_times).
+        sfreq (float): Sampling frequency of the data in Hz.
+        bands (Optional[Dict[str, Tuple[float, float]]]): Mapping of band names to (fmin, fmax) in Hz, both inclusive.
+            The bands are returned in the order of the mapping. Defaults to `FREQ_BANDS`.
+        precision_hz (float): Size of each frequency bin in Hz. The FFT length is `ceil(sfreq / precision_hz)`.
+    Returns:
+        np.ndarray: Band power of shape (n_windows, n_channels, n_bands, 2), holding the absolute power and the power
+            relative to the total power over all frequencies along the last axis, see `POWER_KINDS`.
+    """
+    if bands is None:
+        bands = FREQ_BANDS
+    n_fft = int(np.ceil(sfreq / precision_hz))
+    psds, freqs = mne.time_frequency.psd_array_welch(data, sfreq, n_fft=n_fft, average="mean", verbose=False)
+
+    powers = np.empty(psds.shape[:-1] + (len(bands), len(POWER_KINDS)), dtype=psds.dtype)
+    for i, (fmin, fmax) in enumerate(bands.values()):
+        powers[..., i, 0] = psds[..., (freqs >= fmin) & (freqs <= fmax)].mean(axis=-1)
+    # normalizing the PSD by its total power and then averaging within a band equals normalizing the band average
+    powers[..., 1] = powers[..., 0] / psds.sum(axis=-1)[..., None]
+    return powers
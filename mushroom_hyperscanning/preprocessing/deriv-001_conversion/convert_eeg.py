@@ -1,30 +1,37 @@
+from typing import List, Optional
+
 import mne
 from mne_bids import BIDSPath
 
+from mushroom_hyperscanning.utils import profile, replace_file
+
 
-def convert_eeg(root: str):
+def convert_eeg(root: str, sessions: Optional[List[str]] = None):
     """
-    Convert triggers to annotations for all EEG files.
+    Convert triggers to annotations for all EEG files, or only for the EEG files of `sessions` if provided.
     """
     paths = BIDSPath(subject=".*", session=".*", task="psilo", datatype="eeg", root=root).match()
+    paths = [path for path in paths if sessions is None or path.session in sessions]
     for path in paths:
-        raw = mne.io.read_raw(path, preload=True)
+        with profile("convert_eeg", subject=path.subject, session=path.session):
+            raw = mne.io.read_raw(path, preload=True)
 
-        # find events and save as annotations
-        events = mne.find_events(raw, "Trigger")
-        raw.set_annotations(mne.annotations_from_events(events, raw.info["sfreq"]))
+            # find events and save as annotations
+            events = mne.find_events(raw, "Trigger")
+            raw.set_annotations(mne.annotations_from_events(events, raw.info["sfreq"]))
 
-        # rename channels to standard names
-        raw.rename_channels(lambda x: x.replace("EEG ", "").replace("-Pz", "").replace("X1:", ""))
-        raw.set_channel_types({"ECG": "ecg", "CM": "misc"})
+            # rename channels to standard names
+            raw.rename_channels(lambda x: x.replace("EEG ", "").replace("-Pz", "").replace("X1:", ""))
+            raw.set_channel_types({"ECG": "ecg", "CM": "misc"})
 
-        # re-reference to linked mastoids
-        raw.set_eeg_reference(ref_channels=["A1", "A2"])
+            # re-reference to linked mastoids
+            raw.set_eeg_reference(ref_channels=["A1", "A2"])
 
-        # remove unused channels
-        raw.drop_channels(["Trigger", "Event", "X2:", "X3:"])
-        if path.subject != "01":
-            # only subject 01 has the ECG channel in the EEG file
-            raw.drop_channels(["ECG"])
+            # remove unused channels
+            raw.drop_channels(["Trigger", "Event", "X2:", "X3:"])
+            if path.subject != "01":
+                # only subject 01 has the ECG channel in the EEG file
+                raw.drop_channels(["ECG"])
 
-        mne.export.export_raw(path, raw, overwrite=True)
+            with replace_file(str(path.fpath)) as tmp_path:
+                mne.export.export_raw(tmp_path, raw, overwrite=True)
@@ -1,14 +1,20 @@
 """
 1. Convert triggers to annotations for all EEG files.
-2. Merge individual EEG recordings of ceremony 1, sub-03 into a single file, aligned to the EEG from sub-01.
+2. Merge EEG recordings split into several files into a single file, aligned to the EEG from sub-01.
 """
 
+from typing import List, Optional
+
+from mushroom_hyperscanning.utils import profile
+
 from .convert_eeg import convert_eeg
-from .merge_ceremony1_eeg_splits import merge_ceremony1_eeg_splits
+from .merge_eeg_splits import merge_eeg_splits
 
 
-def main(derivative_dir: str):
+def main(derivative_dir: str, sessions: Optional[List[str]] = None):
     # convert triggers to annotations for all EEG files
-    convert_eeg(derivative_dir)
-    # merge ceremony 1 EEG data of sub-03
-    merge_ceremony1_eeg_splits(derivative_dir)
+    with profile("convert_eeg"):
+        convert_eeg(derivative_dir, sessions)
+    # merge split EEG recordings, e.g. ceremony 1 of sub-03
+    with profile("merge_eeg_splits"):
+        merge_eeg_splits(derivative_dir, sessions)
@@ -0,0 +1,364 @@
+import os
+from datetime import datetime
+from os.path import basename
+from typing import Any, Dict, List, Optional, Tuple
+
+import mne
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+from mne._fiff.utils import _mult_cal_one
+from mne_bids import BIDSPath
+
+from mushroom_hyperscanning.data import eeg_metadata, read_eeg, remove_eeg, save_eeg
+from mushroom_hyperscanning.sync import align_triggers, fit_clocks, resample_positions, sync_error, update_sync_report
+from mushroom_hyperscanning.utils import add_profile_records, profiled
+
+SYNC_TRIGGER = "1"
+MERGE_REPORT_FILE = "merge_report.json"
+
+
+def load_eeg_pre_merge(sub: str, ceremony: str, root: str) -> Tuple[List[BIDSPath], List[mne.io.Raw]]:
+    paths = BIDSPath(
+        subject=sub,
+        session=ceremony,
+        task="psilo",
+        datatype="eeg",
+        root=root,
+    ).match()
+
+    raws = [read_eeg(path.fpath) for path in paths]
+    return paths, raws
+
+
+def sync_trigger_onsets(raw: mne.io.Raw) -> np.ndarray:
+    """
+    Onsets of the synchronization triggers of `raw` in seconds from its first sample.
+    """
+    annot = raw.annotations
+    return annot.onset[annot.description == SYNC_TRIGGER] - raw.first_time
+
+
+def split_offsets(
+    ref_onsets: np.ndarray, raws: List[mne.io.Raw], tolerance: float = 2.0, fit_drift: bool = True
+) -> Tuple[np.ndarray, float, List[Dict[str, Any]]]:
+    """
+    Find the start of each split recording in seconds from the start of the reference recording, and the clock drift
+    between the recording devices. A split often contains a single synchronization trigger, which cannot be matched by
+    its intervals alone, so the triggers of all splits are first placed on the clock of the recording device using the
+    measurement dates of the splits and matched to the reference triggers as one train. The offset of each split and
+    the drift shared by all splits are then fitted to the matched triggers.
+
+    Parameters
+    ----------
+    ref_onsets : np.ndarray
+        Synchronization trigger onsets of the reference recording in seconds
+    raws : list of mne.io.Raw
+        Split recordings in chronological order
+    tolerance : float
+        Maximum timing error of a matched trigger in seconds, covering the one second resolution of the measurement
+        dates
+    fit_drift : bool
+        Whether to fit the clock drift between the devices, see `fit_clocks`
+
+    Returns
+    -------
+    offsets : np.ndarray
+        Start of each split in seconds relative to the reference recording
+    scale : float
+        Duration of one second of the split recordings on the reference clock
+    report : list of dict
+        Clock model and residual sync error of each split
+    """
+    starts = np.array([(raw.info["meas_date"] - raws[0].info["meas_date"]).total_seconds() for raw in raws])
+    onsets = [sync_trigger_onsets(raw) for raw in raws]
+    device_onsets = np.concatenate([start + split_onsets for start, split_onsets in zip(starts, onsets)])
+    split_indices = np.repeat(np.arange(len(raws)), [len(split_onsets) for split_onsets in onsets])
+    # the measurement dates are too coarse for a drift estimate, which is fitted to the split times below
+    alignment = align_triggers(ref_onsets, device_onsets, tolerance=tolerance, fit_drift=False)
+
+    groups = split_indices[alignment["indices"]]
+    ref_times = ref_onsets[alignment["ref_indices"]]
+    times = device_onsets[alignment["indices"]] - starts[groups]
+    offsets, scale = fit_clocks(ref_times, times, groups, len(raws), fit_drift)
+    residuals = ref_times - (offsets[groups] + scale * times)
+
+    matched = np.flatnonzero(~np.isnan(offsets))
+    report = []
+    for i, split_onsets in enumerate(onsets):
+        if np.isnan(offsets[i]):
+            # no trigger of this split was matched, place it relative to the closest matched split on the device clock
+            print(f"Warning: no synchronization trigger matched for split {i + 1}, using its measurement date")
+            j = matched[np.argmin(np.abs(starts[matched] - starts[i]))]
+            offsets[i] = offsets[j] + scale * (starts[i] - starts[j])
+        report.append(
+            {
+                "offset": float(offsets[i]),
+                "drift_ppm": (scale - 1) * 1e6,
+                "n_triggers": len(split_onsets),
+                "n_matched": int(np.sum(groups == i)),
+                **sync_error(residuals[groups == i]),
+            }
+        )
+        print(
+            f"split {i + 1}: offset {offsets[i]:.3f} s, {report[-1]['n_matched']}/{len(split_onsets)} triggers "
+            f"matched, max residual {report[-1]['max_error_ms']:.1f} ms"
+        )
+    print(f"clock drift: {report[0]['drift_ppm']:.2f} ppm")
+    return offsets, scale, report
+
+
+class RawMergedSplits(mne.io.BaseRaw):
+    """
+    Raw object placing split recordings at their offsets in seconds from the start of the reference recording, without
+    loading them. Samples are read from the splits on demand, so the merged recording can be written block by block
+    with `save_eeg` in bounded memory. If the clock of the splits drifts against the reference clock (`scale` other
+    than 1), the splits are resampled onto the reference sample times with `resample_positions`, otherwise they are
+    shifted by whole samples. Gaps before and between the splits read as zeros, and samples overlapping the previous
+    split or preceding the reference recording are dropped.
+
+    Args:
+        raws (List[mne.io.Raw]): Split recordings in chronological order, preloading them is not required.
+        offsets (np.ndarray): Start of each split in seconds relative to the reference recording.
+        scale (float): Duration of one second of the split recordings on the reference clock.
+        meas_date (Optional[datetime]): Measurement date of the reference recording.
+    """
+
+    def __init__(
+        self, raws: List[mne.io.Raw], offsets: np.ndarray, scale: float = 1.0, meas_date: Optional[datetime] = None
+    ):
+        info = raws[0].info.copy()
+        sfreq = info["sfreq"]
+        with info._unlock():
+            info["meas_date"] = meas_date
+            # samples are returned in physical units by the splits
+            for ch in info["chs"]:
+                ch["cal"], ch["range"] = 1.0, 1.0
+
+        # range of merged samples taken from each split, and the first merged sample of the split
+        splits = []
+        onset, duration, description, ch_names = [], [], [], []
+        joins = set()
+        end = 0
+        for raw, offset in zip(raws, offsets):
+            if scale == 1:
+                start = int(np.round(offset * sfreq))
+                stop = start + raw.n_times
+            else:
+                start = int(np.ceil(offset * sfreq))
+                stop = int(np.floor((offset + scale * (raw.n_times - 1) / sfreq) * sfreq)) + 1
+            lo = max(start, end)
+            splits.append((raw, lo, stop, start, offset))
+
+            # shift the annotations onto the reference clock, dropping those in overlapping samples
+            annot = raw.annotations
+            split_onset = annot.onset - raw.first_time
+            split_onset = start / sfreq + split_onset if scale == 1 else offset + scale * split_onset
+            keep = split_onset >= lo / sfreq
+            onset.append(split_onset[keep])
+            duration.append(annot.duration[keep])
+            description.append(annot.description[keep])
+            ch_names.extend(annot.ch_names[keep])
+            joins.update((lo, stop))
+            end = max(end, stop)
+
+        # mark the joins between the splits and the gaps like `mne.concatenate_raws`
+        for join in sorted(joins - {0, end}):
+            onset.append(np.full(2, join / sfreq))
+            duration.append(np.zeros(2))
+            description.append(np.array(["BAD boundary", "EDGE boundary"]))
+            ch_names.extend([(), ()])
+
+        extras = {"splits": splits, "scale": scale, "sfreq": sfreq, "nchan": info["nchan"]}
+        super().__init__(
+            info,
+            False,
+            last_samps=[end - 1],
+            filenames=[None],
+            raw_extras=[extras],
+            orig_format="double",
+            verbose=False,
+        )
+        onset = np.concatenate(onset)
+        order = np.argsort(onset, kind="stable")
+        self.set_annotations(
+            mne.Annotations(
+                onset[order],
+                np.concatenate(duration)[order],
+                np.concatenate(description)[order],
+                ch_names=[ch_names[i] for i in order],
+            )
+        )
+
+    def _read_segment_file(self, data, idx, fi, start, stop, cals, mult):
+        extras = self._raw_extras[fi]
+        scale, sfreq = extras["scale"], extras["sfreq"]
+        picks = np.arange(extras["nchan"])[idx]
+        block = np.zeros((len(picks), stop - start))
+        for raw, lo, hi, split_start, offset in extras["splits"]:
+            a, b = max(lo, start), min(hi, stop)
+            if a >= b:
+                continue
+            if scale == 1:
+                block[:, a - start : b - start] = raw.get_data(picks, a - split_start, b - split_start)
+                continue
+            # fractional positions of the requested samples in the split, read with the neighbouring samples
+            positions = (np.arange(a, b) / sfreq - offset) / scale * sfreq
+            first = min(max(int(np.floor(positions[0])), 0), raw.n_times - 2)
+            last = min(int(np.floor(positions[-1])) + 2, raw.n_times)
+            block[:, a - start : b - start] = resample_positions(raw.get_data(picks, first, last), positions - first)
+        _mult_cal_one(data, block, slice(None), cals, mult)
+
+
+def find_split_groups(root: str, sessions: Optional[List[str]] = None, reference: str = "01") -> List[Tuple[str, str]]:
+    """
+    Find the subjects and sessions whose EEG is stored in several `split-*` files, or only those of `sessions` if
+    provided. The reference subject is never merged, as the other subjects are aligned to it.
+    """
+    paths = BIDSPath(task="psilo", datatype="eeg", root=root).match()
+    groups = {
+        (path.subject, path.session)
+        for path in paths
+        if path.split is not None and path.subject != reference and (sessions is None or path.session in sessions)
+    }
+    return sorted(groups)
+
+
+def print_recordings(paths: List[BIDSPath], raws: List[mne.io.Raw]) -> None:
+    """
+    Print the measurement date and duration of each recording.
+    """
+    for p, r in zip(paths, raws):
+        duration = r.times[-1] - r.times[0]
+        print(
+            str(p).split("/")[-1],  # filename
+            r.info["meas_date"],  # measurement date
+            f"{int(duration//3600):02d}:{int((duration%3600)//60):02d}:{int(duration%60):02d}",  # duration in HH:MM:SS
+            sep="\t",
+        )
+
+
+def merge_subject_splits(root: str, sub: str, ceremony: str, reference: str = "01") -> Dict[str, Dict[str, Any]]:
+    """
+    Merge the split EEG recordings of a subject and ceremony into a single file aligned to the recording of the
+    reference subject, and remove the split files. The splits are matched to the reference by their synchronization
+    triggers, so recordings that cut out during the ceremony are placed at their original time, with zeros in the gaps.
+
+    Parameters
+    ----------
+    root : str
+        Path to the root of the derivative BIDS dataset
+    sub : str
+        Subject whose recording is split
+    ceremony : str
+        Ceremony identifier
+    reference : str
+        Subject whose single recording defines the timeline of the merged recording
+
+    Returns
+    -------
+    reports : dict
+        Entries of the merge report (`merge`) and of the sync report (`sync`), keyed by file name
+    """
+    ref_paths, ref_raws = load_eeg_pre_merge(reference, ceremony, root)
+    paths, raws = load_eeg_pre_merge(sub, ceremony, root)
+    if len(ref_paths) != 1:
+        raise ValueError(f"Expected a single reference recording for subject {reference} in {ceremony}")
+
+    print(f"subject {reference}")
+    print_recordings(ref_paths, ref_raws)
+    print(f"\nsubject {sub}")
+    print_recordings(paths, raws)
+
+    # match the synchronization triggers of the splits to the reference recording
+    ref_onsets = sync_trigger_onsets(ref_raws[0])
+    offsets, scale, split_report = split_offsets(ref_onsets, raws)
+
+    # align the splits to the reference recording
+    merged = RawMergedSplits(raws, offsets, scale, ref_raws[0].info["meas_date"])
+
+    # make sure the trigger timings are aligned between the two subjects
+    alignment = align_triggers(ref_onsets, sync_trigger_onsets(merged), fit_drift=False)
+    merged_error = sync_error(alignment["residuals"])
+    print(f"sync error after merging: max {merged_error['max_error_ms']:.1f} ms")
+
+    # stream the aligned data into a single memory-mapped file
+    save_eeg(merged, sub, ceremony, root, fmt="npy")
+    merged_path = basename(eeg_metadata(sub, ceremony, root)["path"])
+
+    # remove the original splits
+    for path in paths:
+        if os.path.exists(path.fpath):
+            remove_eeg(path.fpath)
+
+    # gaps before each split on the reference timeline, negative if the split overlaps the previous one
+    sfreq = merged.info["sfreq"]
+    end = 0
+    splits = []
+    for path, (_, _, stop, start, _), entry in zip(paths, merged._raw_extras[0]["splits"], split_report):
+        splits.append({"file": basename(path.fpath), "gap_before": (start - end) / sfreq, **entry})
+        end = max(end, stop)
+
+    ref_name = basename(ref_paths[0].fpath)
+    return {
+        "merge": {
+            merged_path: {
+                "subject": sub,
+                "session": ceremony,
+                "reference": ref_name,
+                "duration": merged.n_times / sfreq,
+                "drift_ppm": (scale - 1) * 1e6,
+                "splits": splits,
+                **merged_error,
+            }
+        },
+        "sync": {
+            **{basename(path.fpath): {"reference": ref_name, **entry} for path, entry in zip(paths, split_report)},
+            merged_path: {"reference": ref_name, **merged_error},
+        },
+    }
+
+
+def merge_eeg_splits(
+    root: str, sessions: Optional[List[str]] = None, reference: str = "01", n_jobs: int = -1
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Merge the split EEG recordings of every subject and ceremony in a process pool, see `merge_subject_splits`. The
+    merged recordings are summarized in the merge report of the derivative (`merge_report.json`), with the gap before
+    each split and the residual sync error of its triggers, and added to the sync report (`sync_report.json`).
+
+    Parameters
+    ----------
+    root : str
+        Path to the root of the derivative BIDS dataset
+    sessions : list of str | None
+        Ceremonies to process. If None, all ceremonies are processed.
+    reference : str
+        Subject whose recordings define the timeline of the merged recordings
+    n_jobs : int
+        Number of recordings merged in parallel. -1 means using all processors. The splits are streamed into the
+        merged file, so each job only holds a few blocks of samples in memory.
+
+    Returns
+    -------
+    report : dict
+        The entries added to the merge report, keyed by merged file name
+    """
+    root = os.path.abspath(root)
+    groups = find_split_groups(root, sessions, reference)
+    if len(groups) == 0:
+        return {}
+    print(f"Merging split recordings of {len(groups)} subject/ceremony pairs.")
+
+    results = Parallel(n_jobs=min(len(groups), effective_n_jobs(n_jobs)))(
+        delayed(profiled)(merge_subject_splits, root, sub, ceremony, reference) for sub, ceremony in groups
+    )
+
+    # collect the reports and run profiles of the jobs, the report files are only written by this process
+    merge_report, sync_report = {}, {}
+    for (sub, ceremony), (reports, records) in zip(groups, results):
+        add_profile_records(records, subject=sub, session=ceremony)
+        merge_report.update(reports["merge"])
+        sync_report.update(reports["sync"])
+    update_sync_report(root, merge_report, MERGE_REPORT_FILE)
+    update_sync_report(root, sync_report)
+    return merge_report
@@ -1,62 +1,103 @@
 import os
+import subprocess
+from typing import List, Optional
 
 import numpy as np
 from pydub import AudioSegment
 
-from mushroom_hyperscanning.data import load_audio, load_eeg
+from mushroom_hyperscanning.data import eeg_metadata, load_audio, load_eeg
+from mushroom_hyperscanning.utils import profile, replace_file
 
+# ffmpeg raw PCM formats by sample width in bytes
+PCM_FORMATS = {1: "s8", 2: "s16le", 4: "s32le"}
 
-def align_audio_to_eeg(root: str):
+
+def export_shifted_audio(
+    path: str, audio: np.ndarray, rate: int, start: int, n_samples: int, chunk_size: int = 1 << 20
+) -> None:
+    """
+    Encode `n_samples` samples of mono `audio`, starting at sample `start`, to an mp3 file. Parts of the range before
+    the start or past the end of the audio are filled with silence. The samples are piped to ffmpeg chunk by chunk, so
+    the shifted and padded audio is never materialized in memory.
+
+    Args:
+        path (str): Output mp3 file.
+        audio (np.ndarray): Integer samples, e.g. the memory map returned by `load_audio`.
+        rate (int): Sample rate in Hz.
+        start (int): Index of the first output sample in `audio`, negative to prepend silence.
+        n_samples (int): Number of output samples.
+        chunk_size (int): Number of samples written to the encoder at once.
+    """
+    command = [AudioSegment.converter, "-y", "-v", "error", "-f", PCM_FORMATS[audio.dtype.itemsize]]
+    command += ["-ar", str(rate), "-ac", "1", "-i", "pipe:0", "-f", "mp3", path]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    # little-endian buffer reused for every chunk, zeros where the chunk extends beyond the audio
+    buffer = np.empty(chunk_size, dtype=audio.dtype.newbyteorder("<"))
+    try:
+        for i in range(0, n_samples, chunk_size):
+            lo, hi = start + i, start + min(i + chunk_size, n_samples)
+            src_lo, src_hi = max(lo, 0), min(hi, len(audio))
+            chunk = buffer[: hi - lo]
+            if src_lo < src_hi:
+                chunk[: src_lo - lo] = 0
+                chunk[src_lo - lo : src_hi - lo] = audio[src_lo:src_hi]
+                chunk[src_hi - lo :] = 0
+            else:
+                chunk[:] = 0
+            process.stdin.write(memoryview(chunk))
+    except BrokenPipeError:
+        # ffmpeg exited early, its error message is reported below
+        pass
+    finally:
+        _, stderr = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to encode {path}: {stderr.decode(errors='replace')}")
+
+
+def align_audio_to_eeg(root: str, sessions: Optional[List[str]] = None):
     # audio offsets hardcoded based on manual inspection currently contains a random offset
     # TODO: reconstruct exact audio timings
     ceremonies = {"ceremony1": 1724, "ceremony2": 96}
+    if sessions is not None:
+        ceremonies = {ceremony: offset for ceremony, offset in ceremonies.items() if ceremony in sessions}
 
     for ceremony, audio_trigger_offset in ceremonies.items():
-        # load EEG
-        curandero_eeg = load_eeg("01", ceremony, root)
-        curandero_annot = curandero_eeg.annotations.to_data_frame(time_format="ms")
-        curandero_annot["onset"] = curandero_annot["onset"] / 1000  # Convert to seconds
-        curandero_audio_triggers = curandero_annot[curandero_annot["description"] == "8"]
-        curandero_trigger_onset = curandero_audio_triggers["onset"].values[-1]
-
-        # load audio
-        audio_path = os.path.join(root, "audio", f"ses-{ceremony}", f"audio_ses-{ceremony}_task-psilo_audio.mp3")
-
-        # Load the MP3 file
-        print("Loading audio file...", end="", flush=True)
-        try:
-            audio, audio_rate = load_audio(ceremony, root)
-        except FileNotFoundError as e:
-            if "No such file or directory: 'ffprobe'" in str(e):
-                raise RuntimeError("ffprobe is required to load audio files but was not found. Please install ffmpeg/ffprobe and ensure it is in your PATH.")
-            raise
-        print("done")
-
-        print(f"Audio duration: {audio.shape[0] / audio_rate:.2f} seconds")
-
-        # cut audio to start at the same time as EEG
-        audio_start = audio_trigger_offset - curandero_trigger_onset
-        audio_start = int(audio_start * audio_rate)
-        if audio_start < 0:
-            # pad the beginning of the audio with silence
-            silence = np.zeros(-audio_start, dtype=audio.dtype)
-            audio = np.concatenate([silence, audio])
-            audio_start = 0
-
-        audio_end = audio_start + int(curandero_eeg.times[-1] * audio_rate)
-        if audio_end > audio.shape[0]:
-            # pad the end of the audio with silence
-            silence = np.zeros(audio_end - audio.shape[0], dtype=audio.dtype)
-            audio = np.concatenate([audio, silence])
-
-        # cut audio to the same length as EEG
-        audio = audio[audio_start : audio_start + int(curandero_eeg.times[-1] * audio_rate)]
-
-        print(f"Audio duration after cutting/padding: {audio.shape[0] / audio_rate:.2f} seconds")
-        print(f"EEG duration: {curandero_eeg.times[-1]:.2f} seconds")
-        print("Saving aligned audio file...", end="", flush=True)
-
-        # save audio
-        audio = AudioSegment(audio.tobytes(), frame_rate=audio_rate, sample_width=audio.dtype.itemsize, channels=1)
-        audio.export(audio_path, format="mp3")
-        print("done")
+        with profile("align_audio_to_eeg", session=ceremony):
+            # load EEG annotations and duration, without reading the EEG data
+            curandero_meta = eeg_metadata("01", ceremony, root)
+            eeg_duration = (curandero_meta["n_times"] - 1) / curandero_meta["sfreq"]
+            curandero_annot = load_eeg("01", ceremony, root, annotations_only=True).to_data_frame(time_format="ms")
+            curandero_annot["onset"] = curandero_annot["onset"] / 1000  # Convert to seconds
+            curandero_audio_triggers = curandero_annot[curandero_annot["description"] == "8"]
+            curandero_trigger_onset = curandero_audio_triggers["onset"].values[-1]
+
+            # load audio
+            audio_path = os.path.join(root, "audio", f"ses-{ceremony}", f"audio_ses-{ceremony}_task-psilo_audio.mp3")
+
+            # Load the MP3 file
+            print("Loading audio file...", end="", flush=True)
+            try:
+                audio, audio_rate = load_audio(ceremony, root)
+            except FileNotFoundError as e:
+                if "No such file or directory: 'ffprobe'" in str(e):
+                    raise RuntimeError("ffprobe is required to load audio files but was not found. Please install ffmpeg/ffprobe and ensure it is in your PATH.")
+                raise
+            print("done")
+
+            print(f"Audio duration: {audio.shape[0] / audio_rate:.2f} seconds")
+
+            # audio sample at which the EEG starts, negative if the audio starts after the EEG
+            audio_start = audio_trigger_offset - curandero_trigger_onset
+            audio_start = int(audio_start * audio_rate)
+            # cut or pad audio to the same length as EEG
+            n_samples = int(eeg_duration * audio_rate)
+
+            print(f"Audio duration after cutting/padding: {n_samples / audio_rate:.2f} seconds")
+            print(f"EEG duration: {eeg_duration:.2f} seconds")
+            print("Saving aligned audio file...", end="", flush=True)
+
+            # stream the shifted and padded audio to the encoder
+            with replace_file(audio_path) as tmp_path:
+                export_shifted_audio(tmp_path, audio, audio_rate, audio_start, n_samples)
+            print("done")
@@ -1,109 +1,226 @@
 import os
 import shutil
-from os.path import join
+from fractions import Fraction
+from os.path import dirname, join
+from typing import Dict, List, Optional, Tuple
 
 import mne
 import numpy as np
 import pandas as pd
-
-from mushroom_hyperscanning.data import load_eeg, save_eeg
-
-
-def load_custom_ecg(subject, session, bids_root, offset=0):
+from scipy.signal import resample_poly
+
+from mushroom_hyperscanning.data import eeg_metadata, load_eeg, save_eeg
+from mushroom_hyperscanning.sync import align_triggers, resample_positions, sync_error, update_sync_report
+from mushroom_hyperscanning.utils import cached_decode, profile
+
+ECG_COLUMN = "ExG [1]-ch1"
+TRIGGER_COLUMN = "ExG [2]-ch1"
+TRIGGER_THRESHOLD = -350000
+
+
+def csv_column_to_npy(path: str, out_path: str, column: str, chunksize: int = 1 << 20) -> Dict[str, int]:
+    """
+    Parse a single column of a CSV file in chunks and store it as a float32 `.npy` array, see `cached_decode`.
+    """
+    # append the parsed chunks to a raw file first, as the number of rows is only known at the end
+    raw_path = out_path + ".raw"
+    n_rows = 0
+    with open(raw_path, "wb") as f:
+        for chunk in pd.read_csv(path, usecols=[column], dtype={column: np.float32}, chunksize=chunksize):
+            chunk[column].to_numpy().tofile(f)
+            n_rows += len(chunk)
+    np.save(out_path, np.memmap(raw_path, dtype=np.float32, mode="r", shape=(n_rows,)))
+    os.remove(raw_path)
+    return {"n_rows": n_rows}
+
+
+def load_custom_ecg(
+    subject: str, session: str, bids_root: str, offset: float = 0
+) -> Tuple[np.ndarray, np.ndarray, float, int]:
+    """
+    Load the ECG and trigger signals recorded separately from the EEG. The CSV exports are parsed once and cached as
+    binary arrays in `<bids_root>/../.cache/ecg`, which are memory-mapped on later calls.
+
+    Parameters
+    ----------
+    subject : str
+        Subject identifier
+    session : str
+        Ceremony identifier
+    bids_root : str
+        Path to the derivative directory
+    offset : float
+        Time in seconds before which the recording is discarded
+
+    Returns
+    -------
+    ecg : np.ndarray
+        ECG samples after `offset`
+    trigger : np.ndarray
+        Trigger samples after `offset`
+    sfreq : float
+        Sampling frequency of the ECG recording
+    first_sample : int
+        Index of the first returned sample in the full recording
+    """
     # Construct the file path manually
     file_path = f"{bids_root}/sub-{subject}/ses-{session}/ecg/sub-{subject}_ses-{session}_task-psilo_ecg.csv"
-    file_path_trigger = f"{bids_root}/sub-{subject}/ses-{session}/ecg/sub-{subject}_ses-{session}_task-psilo_ecg-trigger.csv"
+    file_path_trigger = (
+        f"{bids_root}/sub-{subject}/ses-{session}/ecg/sub-{subject}_ses-{session}_task-psilo_ecg-trigger.csv"
+    )
     file_path_info = f"{bids_root}/sub-{subject}/ses-{session}/ecg/sub-{subject}_ses-{session}_task-psilo_info.csv"
 
     # Load the data
     ecg_info = pd.read_csv(file_path_info)
-    sfreq = ecg_info.loc[1, "samplingrate"]
-
-    ecg_data = pd.read_csv(file_path)
-    ecg_data.index /= sfreq  # Convert to seconds
-    ecg_trigger = pd.read_csv(file_path_trigger)
-    ecg_trigger.index /= sfreq  # Convert to seconds
-
-    # remove offset from the data
-    ecg_data = ecg_data[ecg_data.index > offset]
-    ecg_trigger = ecg_trigger[ecg_trigger.index > offset]
-
-    return ecg_data, ecg_trigger, sfreq
-
-
-def align_ecg_to_eeg(root: str):
+    sfreq = float(ecg_info.loc[1, "samplingrate"])
+
+    cache_dir = join(dirname(os.path.abspath(bids_root)), ".cache", "ecg")
+    ecg, _ = cached_decode(
+        file_path, cache_dir, "ecg", lambda path, out_path: csv_column_to_npy(path, out_path, ECG_COLUMN)
+    )
+    trigger, _ = cached_decode(
+        file_path_trigger,
+        cache_dir,
+        "trigger",
+        lambda path, out_path: csv_column_to_npy(path, out_path, TRIGGER_COLUMN),
+    )
+
+    # remove offset from the data, keeping samples strictly after it
+    first_sample = int(np.floor(offset * sfreq)) + 1 if offset > 0 else 0
+    return ecg[first_sample:], trigger[first_sample:], sfreq, first_sample
+
+
+def find_trigger_onsets(trigger: np.ndarray, threshold: float = TRIGGER_THRESHOLD) -> np.ndarray:
+    """
+    Find the samples at which the trigger signal crosses below `threshold`. A trigger active on the first sample counts
+    as an onset.
+    """
+    active = trigger < threshold
+    return np.flatnonzero(active & ~np.concatenate([[False], active[:-1]]))
+
+
+def resample_to_eeg_clock(
+    ecg: np.ndarray,
+    n_times: int,
+    eeg_sfreq: float,
+    offset: float,
+    scale: float,
+    ecg_start: float,
+    ecg_rate: float,
+    block_size: int = 1 << 20,
+) -> np.ndarray:
+    """
+    Interpolate the ECG at the times of the EEG samples, given the clock model `eeg_time = offset + scale * ecg_time`.
+    The fractional ECG positions are computed and interpolated in blocks of `block_size` EEG samples, so only the output
+    is allocated at full length. Before the start of the ECG recording, the data is padded with zeros, and after its
+    end, the last value is held.
+
+    Parameters
+    ----------
+    ecg : np.ndarray
+        ECG samples at `ecg_rate`
+    n_times : int
+        Number of EEG samples
+    eeg_sfreq : float
+        Sampling frequency of the EEG
+    offset, scale : float
+        Clock model mapping ECG times to EEG times, see `align_triggers`
+    ecg_start : float
+        Time of the first ECG sample on the ECG clock in seconds
+    ecg_rate : float
+        Sampling frequency of `ecg`
+    block_size : int
+        Number of EEG samples interpolated at once
+
+    Returns
+    -------
+    aligned : np.ndarray
+        ECG samples at the times of the EEG samples
+    """
+    aligned = np.empty(n_times)
+    for start in range(0, n_times, block_size):
+        # EEG sample j corresponds to ECG time (j / eeg_sfreq - offset) / scale
+        positions = (np.arange(start, min(start + block_size, n_times)) / eeg_sfreq - offset) / scale
+        positions = (positions - ecg_start) * ecg_rate
+        block = aligned[start : start + len(positions)]
+        block[:] = resample_positions(ecg, positions)
+        block[positions < 0] = 0
+        block[positions > len(ecg) - 1] = ecg[-1]
+    return aligned
+
+
+def align_ecg_to_eeg(root: str, sessions: Optional[List[str]] = None):
     ceremonies = {
         "ceremony1": {"subjs": ["02", "03"], "offset": 1000},
         "ceremony2": {"subjs": ["02", "04"], "offset": 0},
     }
+    if sessions is not None:
+        ceremonies = {ceremony: info for ceremony, info in ceremonies.items() if ceremony in sessions}
 
+    report = {}
     for ceremony, info in ceremonies.items():
-        curandero_eeg = load_eeg("01", ceremony, root)
-        curandero_annot = curandero_eeg.annotations.to_data_frame(time_format="ms")
+        # only the annotations and timing of the curandero EEG are needed
+        curandero_meta = eeg_metadata("01", ceremony, root)
+        eeg_sfreq = curandero_meta["sfreq"]
+        curandero_annot = load_eeg("01", ceremony, root, annotations_only=True).to_data_frame(time_format="ms")
         curandero_annot["onset"] = curandero_annot["onset"] / 1000  # Convert to seconds
-        curandero_ecg_triggers = curandero_annot[curandero_annot["description"] == "9"]
-        curandero_onset = curandero_ecg_triggers["onset"].values.mean()
+        curandero_onsets = curandero_annot["onset"].values[curandero_annot["description"] == "9"]
 
         for subj in info["subjs"]:
-            if subj != "02":
-                # load subject EEG data if available
-                subject_eeg = load_eeg(subj, ceremony, root, preload=True)
-
-            ecg_data, ecg_trigger, sfreq = load_custom_ecg(subj, ceremony, root, offset=info["offset"])
-
-            # find triggers
-            x = (ecg_trigger["ExG [2]-ch1"] < -350000).astype(float)
-            # onset mean of first 5 triggers after offset
-            ecg_onset = x[(x.shift(fill_value=0) == 0) & (x == 1)].index.values[:5].mean()
-
-            if ecg_onset - curandero_onset < 0:
-                # if ECG trigger is before curandero trigger, pad the data
-                pad_duration = abs(ecg_onset - curandero_onset)
-                pad_samples = int(np.ceil(pad_duration * sfreq))
-
-                # Create padding dataframes
-                pad_index = np.arange(0, pad_samples) / sfreq
-
-                # Padding for ECG data
-                ecg_data_pad = pd.DataFrame(data=np.zeros(pad_samples), columns=["ExG [1]-ch1"], index=pad_index)
-                # Padding for ECG trigger
-                ecg_trigger_pad = pd.DataFrame(data=np.zeros(pad_samples), columns=["ExG [2]-ch1"], index=pad_index)
-
-                # Shift original ECG indexes forward by pad_duration
-                ecg_data.index += pad_duration
-                ecg_trigger.index += pad_duration
-
-                # Concatenate padding and original data
-                ecg_data = pd.concat([ecg_data_pad, ecg_data])
-                ecg_trigger = pd.concat([ecg_trigger_pad, ecg_trigger])
-            else:
-                # if ECG trigger is after curandero trigger, align the data to start at the same time
-                ecg_data = ecg_data[ecg_data.index > (ecg_onset - curandero_onset)]
-                ecg_data.index -= ecg_data.index[0]
-                ecg_trigger = ecg_trigger[ecg_trigger.index > (ecg_onset - curandero_onset)]
-                ecg_trigger.index -= ecg_trigger.index[0]
-
-            # interpolate ECG to match EEG sampling rate
-            new_times = curandero_eeg.times if subj == "02" else subject_eeg.times
-            ecg_data = np.interp(new_times, ecg_data.index, ecg_data["ExG [1]-ch1"].values)
-            ecg_trigger = np.interp(new_times, ecg_trigger.index, ecg_trigger["ExG [2]-ch1"].values)
-
-            if subj not in ["01", "02"]:
-                # invert ECG data for subjects 03 and 04
-                ecg_data *= -1
-
-            ecg_raw = mne.io.RawArray(
-                ecg_data.reshape(1, -1) / 1e9,
-                mne.create_info(ch_names=["ECG"], ch_types=["ecg"], sfreq=curandero_eeg.info["sfreq"]),
-            )
-
-            if subj == "02":
-                # save just ECG data for subject 02
-                save_eeg(ecg_raw, subj, ceremony, root)
-            else:
-                # load subject EEG data
-                subject_eeg.add_channels([ecg_raw])
-                save_eeg(subject_eeg, subj, ceremony, root)
-
-            # delete old ECG data
-            shutil.rmtree(join(root, f"sub-{subj}", f"ses-{ceremony}", "ecg"))
+            with profile("align_ecg_to_eeg", subject=subj, session=ceremony):
+                n_times = curandero_meta["n_times"]
+                if subj != "02":
+                    # load subject EEG data if available
+                    subject_eeg = load_eeg(subj, ceremony, root, preload=True)
+                    n_times = subject_eeg.n_times
+
+                ecg_data, ecg_trigger, sfreq, first_sample = load_custom_ecg(
+                    subj, ceremony, root, offset=info["offset"]
+                )
+
+                # match all ECG triggers after offset to the curandero triggers and fit the clock drift
+                ecg_trigger_onsets = (first_sample + find_trigger_onsets(ecg_trigger)) / sfreq
+                alignment = align_triggers(curandero_onsets, ecg_trigger_onsets)
+                offset, scale = alignment["offset"], alignment["scale"]
+                report[f"sub-{subj}_ses-{ceremony}_ecg"] = {
+                    "reference": f"sub-01_ses-{ceremony}_eeg",
+                    "offset": offset,
+                    "drift_ppm": (scale - 1) * 1e6,
+                    "n_triggers": len(ecg_trigger_onsets),
+                    "n_matched": len(alignment["indices"]),
+                    **sync_error(alignment["residuals"]),
+                }
+
+                # resample ECG to the nominal EEG sampling rate, the first sample keeps its timing
+                ratio = Fraction(eeg_sfreq / sfreq).limit_denominator(1000)
+                ecg_data = resample_poly(ecg_data, ratio.numerator, ratio.denominator)
+                ecg_rate = sfreq * ratio.numerator / ratio.denominator
+
+                # correct the drift by interpolating the resampled ECG at the times of the EEG samples
+                ecg_data = resample_to_eeg_clock(
+                    ecg_data, n_times, eeg_sfreq, offset, scale, first_sample / sfreq, ecg_rate
+                )
+
+                if subj not in ["01", "02"]:
+                    # invert ECG data for subjects 03 and 04
+                    ecg_data *= -1
+
+                # scale in place, without another full-length copy
+                ecg_data /= 1e9
+                ecg_raw = mne.io.RawArray(
+                    ecg_data.reshape(1, -1),
+                    mne.create_info(ch_names=["ECG"], ch_types=["ecg"], sfreq=eeg_sfreq),
+                )
+
+                if subj == "02":
+                    # save just ECG data for subject 02
+                    save_eeg(ecg_raw, subj, ceremony, root)
+                else:
+                    # load subject EEG data
+                    subject_eeg.add_channels([ecg_raw])
+                    save_eeg(subject_eeg, subj, ceremony, root)
+
+                # delete old ECG data
+                shutil.rmtree(join(root, f"sub-{subj}", f"ses-{ceremony}", "ecg"))
+
+    update_sync_report(root, report)
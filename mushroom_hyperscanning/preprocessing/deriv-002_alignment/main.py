@@ -3,12 +3,18 @@
 2. Merge ECG and EEG data.
 """
 
+from typing import List, Optional
+
+from mushroom_hyperscanning.utils import profile
+
 from .align_audio_to_eeg import align_audio_to_eeg
 from .align_ecg_to_eeg import align_ecg_to_eeg
 
 
-def main(derivative_dir: str):
+def main(derivative_dir: str, sessions: Optional[List[str]] = None):
     # align audio to EEG
-    align_audio_to_eeg(derivative_dir)
+    with profile("align_audio_to_eeg"):
+        align_audio_to_eeg(derivative_dir, sessions)
     # align ECG and EEG data
-    align_ecg_to_eeg(derivative_dir)
+    with profile("align_ecg_to_eeg"):
+        align_ecg_to_eeg(derivative_dir, sessions)
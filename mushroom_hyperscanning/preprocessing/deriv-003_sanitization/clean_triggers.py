@@ -1,12 +1,14 @@
 from os.path import dirname, join
+from typing import List, Optional
 
 import mne
 import pandas as pd
 
 from mushroom_hyperscanning.data import load_eeg, save_eeg
+from mushroom_hyperscanning.utils import profile
 
 
-def clean_triggers(derivative_dir: str) -> None:
+def clean_triggers(derivative_dir: str, sessions: Optional[List[str]] = None) -> None:
     """
     Clean triggers (TODO: ceremony 1)
 
@@ -14,18 +16,23 @@ def clean_triggers(derivative_dir: str) -> None:
     ----------
     derivative_dir : str
         Path to the derivative directory
+    sessions : list of str, optional
+        Ceremonies to process. If None, all ceremonies are processed.
     """
     ceremonies = {
         "ceremony1": ["01", "03"],
         "ceremony2": ["01", "04"],
     }
+    if sessions is not None:
+        ceremonies = {ceremony: subs for ceremony, subs in ceremonies.items() if ceremony in sessions}
 
     cdir = dirname(__file__)
     for ceremony, subs in ceremonies.items():
         annot = pd.read_csv(join(cdir, f"triggers-{ceremony}.csv"))
 
         for sub in subs:
-            eeg = load_eeg(sub, ceremony, derivative_dir, preload=True)
-            new_annot = mne.Annotations(annot["onset"].values / 1000, annot["duration"].values, annot["description"].values)
-            eeg = eeg.set_annotations(new_annot)
-            save_eeg(eeg, sub, ceremony, derivative_dir)
+            with profile("clean_triggers", subject=sub, session=ceremony):
+                eeg = load_eeg(sub, ceremony, derivative_dir, preload=True)
+                new_annot = mne.Annotations(annot["onset"].values / 1000, annot["duration"].values, annot["description"].values)
+                eeg = eeg.set_annotations(new_annot)
+                save_eeg(eeg, sub, ceremony, derivative_dir)
@@ -2,9 +2,14 @@
 1. Clean triggers (TODO: ceremony 2)
 """
 
+from typing import List, Optional
+
+from mushroom_hyperscanning.utils import profile
+
 from .clean_triggers import clean_triggers
 
 
-def main(derivative_dir: str):
+def main(derivative_dir: str, sessions: Optional[List[str]] = None):
     # clean triggers
-    clean_triggers(derivative_dir)
+    with profile("clean_triggers"):
+        clean_triggers(derivative_dir, sessions)
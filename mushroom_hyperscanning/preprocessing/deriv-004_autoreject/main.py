@@ -2,9 +2,14 @@
 1. Clean triggers (TODO: ceremony 2)
 """
 
+from typing import List, Optional
+
+from mushroom_hyperscanning.utils import profile
+
 from .reject import reject
 
 
-def main(derivative_dir: str):
+def main(derivative_dir: str, sessions: Optional[List[str]] = None):
     # clean triggers
-    reject(derivative_dir)
+    with profile("reject"):
+        reject(derivative_dir, sessions=sessions)
@@ -1,6 +1,5 @@
 import os
-from os.path import dirname, join
-import mne
+from os.path import basename, dirname, join
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -11,39 +10,93 @@ from mne import Report
 import io
 import sys
 from contextlib import redirect_stdout, redirect_stderr
-
-from mushroom_hyperscanning.data import load_eeg, save_eeg
+from typing import List, Optional
+
+import joblib
+from joblib import Parallel, delayed, effective_n_jobs, parallel_config
+
+from mushroom_hyperscanning.data import (
+    load_eeg,
+    save_eeg,
+    write_epoch_patches,
+    write_reject_log,
+)
+from mushroom_hyperscanning.utils import (
+    add_profile_records,
+    profile,
+    profiled,
+    replace_file,
+)
 import pickle
 
 
-def detect_zero_epochs(epochs):
+def detect_flat_epochs(
+    epochs, min_channels=2, flat_duration=0.1, flat_tol=0.0, chunk_size=500
+):
     """
-    Detect epochs with zeros on multiple channels.
+    Detect epochs with zeros, flat runs or clipped runs on multiple channels.
+
+    An epoch is flagged if at least `min_channels` channels are exactly zero at the
+    same time point, or if at least `min_channels` channels contain a flat run of
+    `flat_duration` seconds. Flat runs sitting at the minimum or maximum of the
+    channel within the epoch are also counted as clipped runs. The data is processed
+    in chunks of epochs, vectorized over channels and time points.
 
     Parameters:
     epochs : mne.Epochs
         The epochs object to analyze
+    min_channels : int
+        Minimum number of affected channels for an epoch to be flagged
+    flat_duration : float
+        Minimum duration of a flat run in seconds
+    flat_tol : float
+        Maximum absolute change between consecutive samples within a flat run
+    chunk_size : int
+        Number of epochs to process at once, bounding the memory use
 
     Returns:
     numpy.ndarray
-        Array of epoch indices that contain zeros on multiple channels
+        Boolean mask of shape (n_epochs,), True for epochs that should be rejected
+    pandas.DataFrame
+        Per-epoch counts of time points with zeros on multiple channels ("zero"),
+        channels with a flat run ("flat") and channels with a clipped run ("clipped")
     """
-    zero_epochs = []
-    data = epochs.get_data()  # shape: (n_epochs, n_channels, n_times)
-
-    for epoch_idx in range(data.shape[0]):
-        epoch_data = data[epoch_idx]
-
-        # Check each time point for zeros across channels
-        for time_idx in range(epoch_data.shape[1]):
-            time_point = epoch_data[:, time_idx]
-            zero_channels = np.sum(time_point == 0)
-
-            # If multiple channels have zeros at the same time point
-            if zero_channels > 1:
-                zero_epochs.append(epoch_idx)
-                break  # Found zeros in this epoch, move to next epoch
-    return np.array(zero_epochs)
+    n_times = len(epochs.times)
+    n_flat = min(max(2, int(round(flat_duration * epochs.info["sfreq"]))), n_times)
+    counts = np.zeros((len(epochs), 3), dtype=int)
+
+    for start in range(0, len(epochs), chunk_size):
+        # shape: (n_epochs_in_chunk, n_channels, n_times)
+        data = epochs.get_data(item=slice(start, start + chunk_size), copy=False)
+        stop = start + len(data)
+
+        # time points with zeros on multiple channels
+        zero = np.sum(data == 0, axis=1) >= min_channels
+        counts[start:stop, 0] = zero.sum(axis=1)
+
+        # flat runs span n_flat samples, i.e. n_flat - 1 consecutive small differences
+        still = np.abs(np.diff(data, axis=-1)) <= flat_tol
+        csum = np.zeros(still.shape[:-1] + (n_times,), dtype=np.int32)
+        np.cumsum(still, axis=-1, out=csum[..., 1:])
+        runs = (
+            csum[..., n_flat - 1 :] - csum[..., : n_times - n_flat + 1]
+        ) == n_flat - 1
+        counts[start:stop, 1] = runs.any(axis=-1).sum(axis=1)
+
+        # clipped runs are flat runs starting at the extreme values of the channel
+        dmax = data.max(axis=-1, keepdims=True)
+        dmin = data.min(axis=-1, keepdims=True)
+        extreme = ((data == dmax) | (data == dmin)) & (dmax > dmin)
+        clipped = runs & extreme[..., : runs.shape[-1]]
+        counts[start:stop, 2] = clipped.any(axis=-1).sum(axis=1)
+
+    counts = pd.DataFrame(counts, columns=["zero", "flat", "clipped"])
+    mask = (
+        (counts["zero"] > 0)
+        | (counts["flat"] >= min_channels)
+        | (counts["clipped"] >= min_channels)
+    ).values
+    return mask, counts
 
 
 def plot_rejection_proportions(data, ch_names):
@@ -87,275 +140,425 @@ def plot_rejection_proportions(data, ch_names):
     return proportions
 
 
-def reject(derivative_dir: str) -> None:
-    ceremonies = {
-        # "ceremony1": ["01", "03"],
-        "ceremony2": ["04"],  # ["01", "04"],
-    }
+def cached_fit(cache_dir, name, fit, epochs, **params):
+    """
+    Run `fit()` or load its result from a content-addressed cache. The cache key is a
+    hash of the epochs data, channel names, sampling frequency and fit parameters, so
+    results are reused across reruns as long as the inputs of the fit are unchanged.
+
+    Parameters:
+    cache_dir : str | None
+        Directory holding the cached results. If None, `fit()` is always called
+    name : str
+        Name of the cached object, used as prefix of the cache file
+    fit : callable
+        Function without arguments returning the object(s) to cache
+    epochs : mne.Epochs
+        The epochs the fit depends on
+    **params
+        Fit parameters that are part of the cache key
 
-    for ceremony, subs in ceremonies.items():
-        for sub in subs:
-            # Capture terminal output while still displaying it
-            output_capture = io.StringIO()
+    Returns:
+    object
+        The result of `fit()`, either computed or loaded from the cache
+    """
+    if cache_dir is None:
+        with profile(name):
+            return fit()
 
-            class TeeOutput:
-                def __init__(self, *files):
-                    self.files = files
+    key = joblib.hash(
+        (epochs.get_data(copy=False), epochs.ch_names, epochs.info["sfreq"], params)
+    )
+    fname = join(cache_dir, f"{name}-{key}.pkl")
+    if os.path.isfile(fname):
+        print(f"Loading cached {name} from {fname}")
+        with open(fname, "rb") as f:
+            return pickle.load(f)
+
+    with profile(name):
+        result = fit()
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first so interrupted runs don't leave broken entries
+    with replace_file(fname) as tmp_path, open(tmp_path, "wb") as f:
+        pickle.dump(result, f)
+    return result
+
+
+class TeeOutput:
+    """
+    File-like object writing to several files at once, used to capture terminal output
+    while still displaying it.
+    """
 
-                def write(self, text):
-                    for f in self.files:
-                        f.write(text)
-                        f.flush()
+    def __init__(self, *files):
+        self.files = files
 
-                def flush(self):
-                    for f in self.files:
-                        f.flush()
+    def write(self, text):
+        for f in self.files:
+            f.write(text)
+            f.flush()
 
-            # Create MNE Report
-            report = Report(
-                verbose=True, title=f"Preprocessing Report - Sub-{sub} Ses-{ceremony}"
-            )
+    def flush(self):
+        for f in self.files:
+            f.flush()
 
-            # Redirect output to both terminal and capture
-            tee_stdout = TeeOutput(sys.stdout, output_capture)
-            tee_stderr = TeeOutput(sys.stderr, output_capture)
-
-            with redirect_stdout(tee_stdout), redirect_stderr(tee_stderr):
-                eeg = load_eeg(sub, ceremony, derivative_dir, preload=True)
-                # Crop to first 20 minutes for faster processing (remove in production)
-                # eeg.crop(tmin=60 * 5, tmax=60 * 10)
-
-                # Add raw data plots to report
-                fig_raw_ts = eeg.plot(duration=30, n_channels=30, show=False)
-                fig_raw_psd = eeg.compute_psd().plot(show=False)
-                report.add_figure(
-                    fig_raw_ts, title="Raw Time Series", section="Raw Data"
-                )
-                report.add_figure(
-                    fig_raw_psd, title="Raw Power Spectral Density", section="Raw Data"
-                )
-                plt.close(fig_raw_ts)
-                plt.close(fig_raw_psd)
-
-                # Filter raw data
-                raw_filtered = eeg.copy().filter(1, 90)
-                raw_filtered = raw_filtered.copy().notch_filter(
-                    np.arange(60, raw_filtered.info["sfreq"] / 2, 60)
-                )
-
-                # Add filtered data plots to report
-                fig_filt_ts = raw_filtered.plot(duration=30, n_channels=30, show=False)
-                fig_filt_psd = raw_filtered.compute_psd().plot(show=False)
-                report.add_figure(
-                    fig_filt_ts, title="Filtered Time Series", section="Filtered Data"
-                )
-                report.add_figure(
-                    fig_filt_psd,
-                    title="Filtered Power Spectral Density",
-                    section="Filtered Data",
-                )
-                plt.close(fig_filt_ts)
-                plt.close(fig_filt_psd)
-
-                # Segment signals in 1s epochs
-                epochs = make_fixed_length_epochs(
-                    raw_filtered, duration=1.0, preload=True
-                )
-                print("==================================")
-                print(
-                    f"Sub-{sub} Ses-{ceremony} - Total epochs before rejection: {len(epochs)}"
-                )
-                zero_epochs = detect_zero_epochs(epochs)
-                print(
-                    f"Detected {len(zero_epochs)} epochs with zeros on multiple channels."
-                )
-                epochs = epochs[~np.isin(np.arange(len(epochs)), zero_epochs)]
-
-                # Run a first autoreject before ICA
-                ar = AutoReject(
-                    n_jobs=-1,
-                    n_interpolate=[4],
-                    consensus=[0.8],
-                    verbose=True,
-                )
-                ar.fit(epochs)
-                arlog = ar.get_reject_log(epochs)
-
-                # Add first autoreject results to report
-                fig, ax = plt.subplots(figsize=(20, 15))
-                arlog.plot("horizontal", ax=ax, show=False)
-                report.add_figure(
-                    fig, title="First AutoReject Log", section="First AutoReject"
-                )
-                plt.close(fig)
-
-                # Fit ICA without bad epochs
-                ica = ICA(
-                    n_components=15, random_state=69, max_iter="auto", verbose=True
-                )
-                ica.fit(epochs[~arlog.bad_epochs])
-
-                # Add ICA components to report
-                fig_ica_comp = ica.plot_components(show=False)
-                fig_ica_sources = ica.plot_sources(epochs, show=False)
-                report.add_figure(
-                    fig_ica_comp,
-                    title="ICA Components Spatial Distribution",
-                    section="ICA",
-                )
-                report.add_figure(
-                    fig_ica_sources, title="ICA Components Time Series", section="ICA"
-                )
-                plt.close(fig_ica_comp)
-                plt.close(fig_ica_sources)
-
-                # Find ECG components
-                ecg_threshold = 0.50
-                ecg_epochs = create_ecg_epochs(raw_filtered, ch_name="ECG")
-                ecg_inds, ecg_scores = ica.find_bads_ecg(
-                    ecg_epochs, ch_name="ECG", method="ctps", threshold=ecg_threshold
-                )
-                if ecg_inds == []:
-                    ecg_inds = [list(abs(ecg_scores)).index(max(abs(ecg_scores)))]
-
-                # Find EOG components
-                eog_threshold = 2
-                eog_epochs = create_eog_epochs(raw_filtered, ch_name=["Fp1", "Fp2"])
-                eog_inds, eog_scores = ica.find_bads_eog(
-                    eog_epochs, ch_name=["Fp1", "Fp2"], threshold=eog_threshold
-                )
-                eog_scores = np.mean(np.abs(eog_scores), axis=0)
-                if eog_inds == []:
-                    # Average EOG scores across channels
-                    eog_inds = [list(abs(eog_scores)).index(max(abs(eog_scores)))]
-
-                # Add ECG/EOG component properties to report
-                ecg_props_text = f"ECG Components: {ecg_inds}\nECG Scores: {ecg_scores[ecg_inds] if len(ecg_inds) > 0 else 'N/A'}\nThreshold: {ecg_threshold}"
-                eog_props_text = f"EOG Components: {eog_inds}\nEOG Scores: {eog_scores[eog_inds] if len(eog_inds) > 0 else 'N/A'}\nThreshold: {eog_threshold}"
-
-                if ecg_inds:
-                    fig_ecg = ica.plot_properties(
-                        ecg_epochs, picks=ecg_inds, show=False
-                    )
-                    report.add_figure(
-                        fig_ecg,
-                        title="ECG Component Properties",
-                        section="Artifact Components",
-                    )
-                    # Close all figures in the list
-                    if isinstance(fig_ecg, list):
-                        for fig in fig_ecg:
-                            plt.close(fig)
-                    else:
-                        plt.close(fig_ecg)
-
-                if eog_inds:
-                    fig_eog = ica.plot_properties(
-                        eog_epochs, picks=eog_inds, show=False
-                    )
-                    report.add_figure(
-                        fig_eog,
-                        title="EOG Component Properties",
-                        section="Artifact Components",
-                    )
-                    # Close all figures in the list
-                    if isinstance(fig_eog, list):
-                        for fig in fig_eog:
-                            plt.close(fig)
-                    else:
-                        plt.close(fig_eog)
-
-                report.add_html(
-                    f"<h3>ECG Component Information</h3><pre>{ecg_props_text}</pre>",
-                    title="ECG Info",
-                    section="Artifact Components",
-                )
-                report.add_html(
-                    f"<h3>EOG Component Information</h3><pre>{eog_props_text}</pre>",
-                    title="EOG Info",
-                    section="Artifact Components",
-                )
-
-                # Reconstruct raw without artifact components
-                print(
-                    f"Sub-{sub} Ses-{ceremony} - ECG components: {ecg_inds}, EOG components: {eog_inds}"
-                )
-                ica.exclude = ecg_inds + eog_inds
-                raw_clean = raw_filtered.copy()
-                ica.apply(raw_clean)
-
-                # Resegment and run autoreject on cleaned data
-                epochs_clean = make_fixed_length_epochs(
-                    raw_clean, duration=1.0, preload=True
-                )
-                epochs_clean = epochs_clean[
-                    ~np.isin(np.arange(len(epochs_clean)), zero_epochs)
-                ]
-
-                ar_clean = AutoReject(
-                    n_jobs=-1, n_interpolate=[4], consensus=[0.8], verbose=True
-                )
-                epochs_clean = ar_clean.fit_transform(epochs_clean)
-
-                arlog_clean = ar_clean.get_reject_log(epochs_clean)
-
-                # Add second autoreject results to report
-                fig, ax = plt.subplots(figsize=(20, 15))
-                arlog_clean.plot("horizontal", ax=ax, show=False)
-                report.add_figure(
-                    fig, title="Second AutoReject Log", section="Final AutoReject"
-                )
-                plt.close(fig)
-
-                # Add rejection proportions plot
-                proportions = plot_rejection_proportions(
-                    arlog_clean.labels, epochs_clean.ch_names
-                )
-                fig_prop = plt.gcf()
-                report.add_figure(
-                    fig_prop,
-                    title="Rejection Proportions by Channel",
-                    section="Final AutoReject",
-                )
-                plt.close(fig_prop)
-
-                print("==================================")
-                print(
-                    f"Sub-{sub} Ses-{ceremony} - Total epochs after rejection: {len(epochs_clean)}/{len(epochs)}"
-                )
-
-            # Add terminal output to report
-            terminal_output = output_capture.getvalue()
-            report.add_html(
-                f"<h2>Terminal Output</h2><pre>{terminal_output}</pre>",
-                title="Terminal Output",
-                section="Processing Log",
-            )
 
-            # Save results
-            eeg_dir = join(derivative_dir, f"sub-{sub}", f"ses-{ceremony}", "eeg")
-            os.makedirs(eeg_dir, exist_ok=True)
+def reject_subject(
+    derivative_dir: str,
+    sub: str,
+    ceremony: str,
+    n_jobs: int = -1,
+    cache_dir: Optional[str] = None,
+) -> None:
+    """
+    Run ICA and AutoReject for a single subject and ceremony, and save the cleaned
+    data, epochs, reject log, report and log file next to the EEG data.
 
-            # Save report as HTML without opening
-            report_path = join(
-                eeg_dir,
-                f"sub-{sub}_ses-{ceremony}_task-psilo_preprocessing-report.html",
-            )
-            report.save(report_path, overwrite=True, open_browser=False)
+    Parameters:
+    derivative_dir : str
+        Path to the derivative directory
+    sub : str
+        Subject identifier
+    ceremony : str
+        Ceremony identifier
+    n_jobs : int
+        Number of parallel jobs used for filtering and AutoReject
+    cache_dir : str | None
+        Directory for cached AutoReject and ICA fits (see `cached_fit`). If None, the
+        models are always fitted from scratch
+    """
+    filter_band = (1, 90)
+    ar_params = dict(n_interpolate=[4], consensus=[0.8])
+    ica_params = dict(n_components=15, random_state=69, max_iter="auto")
 
-            raw_clean.save(
-                join(eeg_dir, f"sub-{sub}_ses-{ceremony}_task-psilo_eeg.fif"),
-                overwrite=True,
+    # Capture terminal output while still displaying it
+    output_capture = io.StringIO()
+
+    # Create MNE Report
+    report = Report(
+        verbose=True, title=f"Preprocessing Report - Sub-{sub} Ses-{ceremony}"
+    )
+
+    # Redirect output to both terminal and capture
+    tee_stdout = TeeOutput(sys.stdout, output_capture)
+    tee_stderr = TeeOutput(sys.stderr, output_capture)
+
+    with redirect_stdout(tee_stdout), redirect_stderr(tee_stderr):
+        eeg = load_eeg(sub, ceremony, derivative_dir, preload=True)
+        # Crop to first 20 minutes for faster processing (remove in production)
+        # eeg.crop(tmin=60 * 5, tmax=60 * 10)
+
+        # Add raw data plots to report
+        fig_raw_ts = eeg.plot(duration=30, n_channels=30, show=False)
+        fig_raw_psd = eeg.compute_psd().plot(show=False)
+        report.add_figure(fig_raw_ts, title="Raw Time Series", section="Raw Data")
+        report.add_figure(
+            fig_raw_psd, title="Raw Power Spectral Density", section="Raw Data"
+        )
+        plt.close(fig_raw_ts)
+        plt.close(fig_raw_psd)
+
+        # Filter raw data
+        raw_filtered = eeg.copy().filter(*filter_band, n_jobs=n_jobs)
+        raw_filtered = raw_filtered.copy().notch_filter(
+            np.arange(60, raw_filtered.info["sfreq"] / 2, 60), n_jobs=n_jobs
+        )
+
+        # Add filtered data plots to report
+        fig_filt_ts = raw_filtered.plot(duration=30, n_channels=30, show=False)
+        fig_filt_psd = raw_filtered.compute_psd().plot(show=False)
+        report.add_figure(
+            fig_filt_ts, title="Filtered Time Series", section="Filtered Data"
+        )
+        report.add_figure(
+            fig_filt_psd,
+            title="Filtered Power Spectral Density",
+            section="Filtered Data",
+        )
+        plt.close(fig_filt_ts)
+        plt.close(fig_filt_psd)
+
+        # Segment signals in 1s epochs
+        epochs = make_fixed_length_epochs(raw_filtered, duration=1.0, preload=True)
+        print("==================================")
+        print(
+            f"Sub-{sub} Ses-{ceremony} - Total epochs before rejection: {len(epochs)}"
+        )
+        flat_epochs, flat_counts = detect_flat_epochs(epochs)
+        print(
+            f"Detected {flat_epochs.sum()} epochs with zeros, flat or clipped "
+            "runs on multiple channels."
+        )
+        epochs = epochs[~flat_epochs]
+
+        # Run a first autoreject before ICA
+        def fit_autoreject():
+            ar = AutoReject(n_jobs=n_jobs, verbose=True, **ar_params)
+            ar.fit(epochs)
+            return ar, ar.get_reject_log(epochs)
+
+        ar, arlog = cached_fit(
+            cache_dir,
+            "autoreject",
+            fit_autoreject,
+            epochs,
+            filter_band=filter_band,
+            **ar_params,
+        )
+
+        # Add first autoreject results to report
+        fig, ax = plt.subplots(figsize=(20, 15))
+        arlog.plot("horizontal", ax=ax, show=False)
+        report.add_figure(fig, title="First AutoReject Log", section="First AutoReject")
+        plt.close(fig)
+
+        # Fit ICA without bad epochs
+        def fit_ica():
+            ica = ICA(verbose=True, **ica_params)
+            ica.fit(epochs[~arlog.bad_epochs])
+            return ica
+
+        ica = cached_fit(
+            cache_dir,
+            "ica",
+            fit_ica,
+            epochs[~arlog.bad_epochs],
+            filter_band=filter_band,
+            **ica_params,
+        )
+
+        # Add ICA components to report
+        fig_ica_comp = ica.plot_components(show=False)
+        fig_ica_sources = ica.plot_sources(epochs, show=False)
+        report.add_figure(
+            fig_ica_comp,
+            title="ICA Components Spatial Distribution",
+            section="ICA",
+        )
+        report.add_figure(
+            fig_ica_sources, title="ICA Components Time Series", section="ICA"
+        )
+        plt.close(fig_ica_comp)
+        plt.close(fig_ica_sources)
+
+        # Find ECG components
+        ecg_threshold = 0.50
+        ecg_epochs = create_ecg_epochs(raw_filtered, ch_name="ECG")
+        ecg_inds, ecg_scores = ica.find_bads_ecg(
+            ecg_epochs, ch_name="ECG", method="ctps", threshold=ecg_threshold
+        )
+        if ecg_inds == []:
+            ecg_inds = [list(abs(ecg_scores)).index(max(abs(ecg_scores)))]
+
+        # Find EOG components
+        eog_threshold = 2
+        eog_epochs = create_eog_epochs(raw_filtered, ch_name=["Fp1", "Fp2"])
+        eog_inds, eog_scores = ica.find_bads_eog(
+            eog_epochs, ch_name=["Fp1", "Fp2"], threshold=eog_threshold
+        )
+        eog_scores = np.mean(np.abs(eog_scores), axis=0)
+        if eog_inds == []:
+            # Average EOG scores across channels
+            eog_inds = [list(abs(eog_scores)).index(max(abs(eog_scores)))]
+
+        # Add ECG/EOG component properties to report
+        ecg_props_text = f"ECG Components: {ecg_inds}\nECG Scores: {ecg_scores[ecg_inds] if len(ecg_inds) > 0 else 'N/A'}\nThreshold: {ecg_threshold}"
+        eog_props_text = f"EOG Components: {eog_inds}\nEOG Scores: {eog_scores[eog_inds] if len(eog_inds) > 0 else 'N/A'}\nThreshold: {eog_threshold}"
+
+        if ecg_inds:
+            fig_ecg = ica.plot_properties(ecg_epochs, picks=ecg_inds, show=False)
+            report.add_figure(
+                fig_ecg,
+                title="ECG Component Properties",
+                section="Artifact Components",
             )
-            epochs_clean.save(
-                join(eeg_dir, f"sub-{sub}_ses-{ceremony}_task-psilo_epochs.fif"),
-                overwrite=True,
+            # Close all figures in the list
+            if isinstance(fig_ecg, list):
+                for fig in fig_ecg:
+                    plt.close(fig)
+            else:
+                plt.close(fig_ecg)
+
+        if eog_inds:
+            fig_eog = ica.plot_properties(eog_epochs, picks=eog_inds, show=False)
+            report.add_figure(
+                fig_eog,
+                title="EOG Component Properties",
+                section="Artifact Components",
             )
-            with open(
-                join(eeg_dir, f"sub-{sub}_ses-{ceremony}_task-psilo_rejectlog.pkl"),
-                "wb",
-            ) as f:
-                pickle.dump(arlog_clean, f)
-
-            for fname in eeg.filenames:
-                os.remove(fname)
+            # Close all figures in the list
+            if isinstance(fig_eog, list):
+                for fig in fig_eog:
+                    plt.close(fig)
+            else:
+                plt.close(fig_eog)
+
+        report.add_html(
+            f"<h3>ECG Component Information</h3><pre>{ecg_props_text}</pre>",
+            title="ECG Info",
+            section="Artifact Components",
+        )
+        report.add_html(
+            f"<h3>EOG Component Information</h3><pre>{eog_props_text}</pre>",
+            title="EOG Info",
+            section="Artifact Components",
+        )
+
+        # Reconstruct raw without artifact components
+        print(
+            f"Sub-{sub} Ses-{ceremony} - ECG components: {ecg_inds}, EOG components: {eog_inds}"
+        )
+        ica.exclude = ecg_inds + eog_inds
+        raw_clean = raw_filtered.copy()
+        ica.apply(raw_clean)
+
+        # Resegment and run autoreject on cleaned data
+        epochs_clean = make_fixed_length_epochs(raw_clean, duration=1.0, preload=True)
+        epochs_clean = epochs_clean[~flat_epochs]
+
+        def fit_autoreject_clean():
+            ar_clean = AutoReject(n_jobs=n_jobs, verbose=True, **ar_params)
+            return ar_clean.fit(epochs_clean)
+
+        ar_clean = cached_fit(
+            cache_dir,
+            "autoreject-clean",
+            fit_autoreject_clean,
+            epochs_clean,
+            filter_band=filter_band,
+            **ar_params,
+        )
+        epochs_clean = ar_clean.transform(epochs_clean)
+
+        arlog_clean = ar_clean.get_reject_log(epochs_clean)
+
+        # Add second autoreject results to report
+        fig, ax = plt.subplots(figsize=(20, 15))
+        arlog_clean.plot("horizontal", ax=ax, show=False)
+        report.add_figure(
+            fig, title="Second AutoReject Log", section="Final AutoReject"
+        )
+        plt.close(fig)
+
+        # Add rejection proportions plot
+        proportions = plot_rejection_proportions(
+            arlog_clean.labels, epochs_clean.ch_names
+        )
+        fig_prop = plt.gcf()
+        report.add_figure(
+            fig_prop,
+            title="Rejection Proportions by Channel",
+            section="Final AutoReject",
+        )
+        plt.close(fig_prop)
+
+        print("==================================")
+        print(
+            f"Sub-{sub} Ses-{ceremony} - Total epochs after rejection: {len(epochs_clean)}/{len(epochs)}"
+        )
+
+    # Add terminal output to report
+    terminal_output = output_capture.getvalue()
+    report.add_html(
+        f"<h2>Terminal Output</h2><pre>{terminal_output}</pre>",
+        title="Terminal Output",
+        section="Processing Log",
+    )
+
+    # Save results
+    eeg_dir = join(derivative_dir, f"sub-{sub}", f"ses-{ceremony}", "eeg")
+    os.makedirs(eeg_dir, exist_ok=True)
+
+    # Save report as HTML without opening
+    report_path = join(
+        eeg_dir,
+        f"sub-{sub}_ses-{ceremony}_task-psilo_preprocessing-report.html",
+    )
+    report.save(report_path, overwrite=True, open_browser=False)
+
+    # Save terminal output as a separate log file for this job
+    log_path = join(eeg_dir, f"sub-{sub}_ses-{ceremony}_task-psilo_preprocessing.log")
+    with open(log_path, "w", encoding="utf-8") as f:
+        f.write(terminal_output)
+
+    # the epochs are stored as their onsets in the reject log and the channels changed
+    # by AutoReject, and are read from the memory-mapped recording by `load_epochs`
+    save_eeg(raw_clean, sub, ceremony, derivative_dir, fmt="npy")
+    write_epoch_patches(
+        join(eeg_dir, f"sub-{sub}_ses-{ceremony}_task-psilo_patches.npy"),
+        epochs_clean,
+        raw_clean,
+    )
+    write_reject_log(
+        join(eeg_dir, f"sub-{sub}_ses-{ceremony}_task-psilo_rejectlog.npy"),
+        arlog_clean.labels,
+        epochs_clean.events[:, 0],
+        arlog_clean.ch_names,
+    )
+
+
+def reject(
+    derivative_dir: str,
+    n_jobs: int = -1,
+    n_subject_jobs: Optional[int] = None,
+    cache: bool = True,
+    sessions: Optional[List[str]] = None,
+) -> None:
+    """
+    Run the rejection of all subjects and ceremonies in a process pool. The CPU budget
+    `n_jobs` is split between the subject jobs running in parallel and the parallelism
+    inside each job (filtering, AutoReject and the BLAS threads used by ICA).
+
+    Parameters:
+    derivative_dir : str
+        Path to the derivative directory
+    n_jobs : int
+        Total number of CPUs to use. -1 means using all processors.
+    n_subject_jobs : int | None
+        Number of subject jobs to run in parallel. Defaults to one job per
+        subject/ceremony, capped by `n_jobs`. Each job holds a full recording in
+        memory, so lower this if memory is limited.
+    cache : bool
+        Whether to reuse AutoReject and ICA fits from previous runs. The cache is
+        stored in `<derivative_dir>/../.cache/<derivative name>`, outside of the
+        derivative directory, so it survives overwriting the derivative.
+    sessions : list of str | None
+        Ceremonies to process. If None, all ceremonies are processed.
+    """
+    ceremonies = {
+        # "ceremony1": ["01", "03"],
+        "ceremony2": ["04"],  # ["01", "04"],
+    }
+    if sessions is not None:
+        ceremonies = {c: subs for c, subs in ceremonies.items() if c in sessions}
+    jobs = [(sub, ceremony) for ceremony, subs in ceremonies.items() for sub in subs]
+    derivative_dir = os.path.abspath(derivative_dir)
+    cache_dir = None
+    if cache:
+        cache_dir = join(dirname(derivative_dir), ".cache", basename(derivative_dir))
+
+    n_cpus = effective_n_jobs(n_jobs)
+    if n_subject_jobs is None:
+        n_subject_jobs = min(len(jobs), n_cpus)
+    n_inner_jobs = max(1, n_cpus // n_subject_jobs)
+    print(
+        f"Running {len(jobs)} rejection jobs, {n_subject_jobs} at a time with "
+        f"{n_inner_jobs} CPUs each."
+    )
+
+    with parallel_config(backend="loky", inner_max_num_threads=n_inner_jobs):
+        results = Parallel(n_jobs=n_subject_jobs)(
+            delayed(profiled)(
+                reject_subject,
+                derivative_dir,
+                sub,
+                ceremony,
+                n_jobs=n_inner_jobs,
+                cache_dir=cache_dir,
+            )
+            for sub, ceremony in jobs
+        )
+
+    # collect the run profiles of the subject jobs
+    for (sub, ceremony), (_, records) in zip(jobs, results):
+        add_profile_records(records, subject=sub, session=ceremony)
@@ -1,17 +1,33 @@
 import argparse
 import ast
+import hashlib
 import importlib
 import os
 import shutil
+from functools import partial
 from glob import glob
-from os.path import dirname, join
+from os.path import dirname, join, relpath
 from pathlib import Path
 from typing import Dict, Optional
 
-from mushroom_hyperscanning.utils import PrintBlock, create_derivative_directory
+from mushroom_hyperscanning.utils import (
+    PrintBlock,
+    changed_sessions,
+    create_derivative_directory,
+    drop_sessions,
+    hash_directory,
+    hash_file,
+    profile,
+    read_manifest,
+    restore_sessions,
+    run_profile,
+    write_manifest,
+    write_profile,
+)
 
 PIPELINE_DIR = Path(__file__).parent.parent / "preprocessing"
 BIDS_ROOT = PIPELINE_DIR.parent.parent / "data" / "bids_dataset"
+PACKAGE_DIR = PIPELINE_DIR.parent
 
 
 def extract_module_docstring(file_path: str) -> Optional[str]:
@@ -67,17 +83,55 @@ def update_readme(steps: Dict[str, str], pipeline_dir: str):
         readme.write("\n".join(new_readme_content))
 
 
-def main(overwrite: bool = False):
+def step_code_hash(step_dir: str) -> str:
+    """
+    Hash the source files of a derivative step, together with the modules of the package the steps rely on (data
+    loading, clock synchronization, utilities, ...), so a change to shared code also reruns the step.
+
+    Parameters
+    ----------
+    step_dir : str
+        Path to the derivative step directory.
+
+    Returns
+    -------
+    str
+        Hexadecimal SHA-1 digest of the step code.
+    """
+    files = sorted(fname for fname in glob(join(step_dir, "*")) if os.path.isfile(fname))
+    files += sorted(glob(join(PACKAGE_DIR, "*.py")))
+    sha1 = hashlib.sha1()
+    for fname in files:
+        sha1.update(f"{Path(relpath(fname, PACKAGE_DIR)).as_posix()}:{hash_file(fname)}".encode())
+    return sha1.hexdigest()
+
+
+def main(overwrite: bool = False, incremental: bool = False, link: bool = False):
     """
     This function discovers all derivative steps in the pipeline, runs them in order,
     and updates the README file with their docstrings.
     A derivative step is defined as a directory named `deriv-<name>` containing a `main.py` file. The `main.py` file
-    should contain a `main` function that takes a single argument: the path to the derivative directory.
+    should contain a `main` function that takes the path to the derivative directory and an optional `sessions` list
+    restricting the ceremonies to process.
+
+    Every derivative records a manifest with the hashes of its input files, of the step code and of its output files.
+    In incremental mode, a step whose code changed is rerun from scratch, and a step whose inputs changed only within
+    some sessions reprocesses just these sessions. Changed outputs then propagate the update to the following steps.
+
+    Every step that runs writes a run profile with the wall time, CPU time, peak memory and I/O of the step, of its
+    functions and of each subject/session next to its derivative directory, as `<derivative>.profile.json` and
+    `<derivative>.profile.csv`.
 
     Parameters
     ----------
     overwrite : bool, optional
         Whether to overwrite existing derivative directories
+    incremental : bool, optional
+        Whether to update existing derivative directories, rerunning only steps and sessions that are out of date
+    link : bool, optional
+        Whether to hardlink unchanged files from the previous derivative when they can't be reflinked, instead of
+        copying them. Hardlinked files share their data with the previous derivatives and the BIDS dataset, so they must
+        only be written through `utils.replace_file`
     """
     # discover all derivative steps in the pipeline
     steps_dirs = sorted(glob(join(PIPELINE_DIR, "deriv-*")))
@@ -100,37 +154,93 @@ def main(overwrite: bool = False):
 
     # run all scripts in order
     previous_derivative = None
-    for name in steps.keys():
-        # check if the derivative already exists
-        derivative_dir = join(dirname(BIDS_ROOT), name)
-        if not overwrite and os.path.exists(derivative_dir):
-            previous_derivative = derivative_dir
-            print(f"Derivative {name} already finished, skipping.")
-            continue
-
-        # load the module
-        module = importlib.import_module(f"mushroom_hyperscanning.preprocessing.deriv-{name}.main")
-        if not hasattr(module, "main"):
-            print(f"\nERROR: Derivative step {name} must contain a main function as the entry point.")
-            return
-
-        print()
-        with PrintBlock(name):
-            # create a new derivative directory for each step
-            previous_derivative = derivative_dir = create_derivative_directory(name, BIDS_ROOT, previous_derivative, overwrite=overwrite)
-
-            # run the main function of the module
-            try:
-                module.main(derivative_dir)
-            except:
-                # clean up the derivative directory if an error occurs
-                shutil.rmtree(derivative_dir)
-                raise
+    with run_profile() as records:
+        for name in steps.keys():
+            derivative_dir = join(dirname(BIDS_ROOT), name)
+            source_dir = str(BIDS_ROOT) if previous_derivative is None else previous_derivative
+            code_hash = step_code_hash(dirname(steps[name]))
+            manifest = read_manifest(derivative_dir) if os.path.exists(derivative_dir) else None
+            source_manifest = read_manifest(source_dir) or {}
+
+            # check if the derivative already exists
+            if not overwrite and not incremental and os.path.exists(derivative_dir):
+                previous_derivative = derivative_dir
+                print(f"Derivative {name} already finished, skipping.")
+                continue
+
+            # fingerprint the inputs, reusing hashes of files that didn't change since they were last hashed
+            known = {**(manifest or {}).get("inputs", {}), **source_manifest.get("outputs", {})}
+            with profile("hash_inputs", step=name):
+                inputs = hash_directory(source_dir, known)
+
+            # in incremental mode, find the sessions of the derivative that are out of date
+            sessions = None
+            if incremental and manifest is not None and manifest["code_hash"] == code_hash:
+                sessions = changed_sessions(manifest["inputs"], inputs)
+                if sessions is not None and len(sessions) == 0:
+                    previous_derivative = derivative_dir
+                    print(f"Derivative {name} is up to date, skipping.")
+                    continue
+
+            # load the module
+            module = importlib.import_module(f"mushroom_hyperscanning.preprocessing.deriv-{name}.main")
+            if not hasattr(module, "main"):
+                print(f"\nERROR: Derivative step {name} must contain a main function as the entry point.")
+                return
+
+            print()
+            with PrintBlock(name), profile(name, step=name):
+                if sessions:
+                    # only reprocess the outdated sessions of the existing derivative
+                    print(f"Updating sessions {', '.join(sorted(sessions))} of derivative {name}")
+                    with profile("restore_sessions"):
+                        restore_sessions(source_dir, derivative_dir, sessions, link=link)
+                    run = partial(module.main, derivative_dir, sessions=sorted(sessions))
+                else:
+                    # create a new derivative directory for each step
+                    with profile("create_derivative_directory"):
+                        derivative_dir = create_derivative_directory(
+                            name, BIDS_ROOT, previous_derivative, overwrite=os.path.exists(derivative_dir), link=link
+                        )
+                    run = partial(module.main, derivative_dir)
+                previous_derivative = derivative_dir
+
+                # run the main function of the module
+                try:
+                    with profile("main"):
+                        run()
+                except:
+                    if sessions:
+                        # only drop the sessions that were being updated, keeping the valid ones and their manifest
+                        drop_sessions(derivative_dir, sessions)
+                    else:
+                        # clean up the derivative directory if an error occurs
+                        shutil.rmtree(derivative_dir)
+                    raise
+
+                # record the inputs, code and outputs of the step for incremental reruns
+                known = {**inputs, **(manifest or {}).get("outputs", {})}
+                with profile("hash_outputs"):
+                    outputs = hash_directory(derivative_dir, known)
+                write_manifest(derivative_dir, {"code_hash": code_hash, "inputs": inputs, "outputs": outputs})
+
+            # write the run profile of the step next to its derivative directory
+            write_profile(f"{derivative_dir}.profile", [record for record in records if record.get("step") == name])
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run derivative pipeline steps.")
     parser.add_argument("--overwrite", action="store_true", help="Overwrite existing derivative directories")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Update existing derivative directories, only rerunning steps and sessions whose inputs or code changed",
+    )
+    parser.add_argument(
+        "--link",
+        action="store_true",
+        help="Hardlink files between derivative directories when they can't be reflinked, instead of copying them",
+    )
     args = parser.parse_args()
 
-    main(overwrite=args.overwrite)
+    main(overwrite=args.overwrite, incremental=args.incremental, link=args.link)
@@ -0,0 +1,187 @@
+import json
+from os.path import exists, join
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+from mushroom_hyperscanning.utils import replace_file
+
+SYNC_REPORT_FILE = "sync_report.json"
+
+
+def _coarse_offset(ref_onsets: np.ndarray, onsets: np.ndarray, tolerance: float, max_offset: Optional[float]) -> float:
+    """
+    Find the clock offset supported by the most trigger pairs. Every pairwise difference between the two trains is a
+    candidate offset, and the candidates are sorted so that the number of differences within `tolerance` of each
+    candidate can be counted with two binary searches instead of a histogram over all offsets.
+    """
+    diffs = np.sort((ref_onsets[:, None] - onsets[None, :]).ravel())
+    if max_offset is not None:
+        diffs = diffs[np.abs(diffs) <= max_offset]
+    if len(diffs) == 0:
+        raise ValueError(f"No trigger pairs within the maximum offset of {max_offset} s")
+
+    support = np.searchsorted(diffs, diffs + tolerance, "right") - np.searchsorted(diffs, diffs - tolerance, "left")
+    # ties, e.g. when one of the trains contains a single trigger, are resolved by the smallest absolute offset
+    best = np.flatnonzero(support == support.max())
+    best = best[np.argmin(np.abs(diffs[best]))]
+    return diffs[np.abs(diffs - diffs[best]) <= tolerance].mean()
+
+
+def _match_nearest(ref_onsets: np.ndarray, predicted: np.ndarray, tolerance: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pair every predicted onset with the nearest reference onset within `tolerance`, keeping only the closest onset
+    if several are paired with the same reference trigger.
+    """
+    pos = np.searchsorted(ref_onsets, predicted)
+    left, right = np.clip(pos - 1, 0, len(ref_onsets) - 1), np.clip(pos, 0, len(ref_onsets) - 1)
+    nearest = np.where(np.abs(ref_onsets[left] - predicted) <= np.abs(ref_onsets[right] - predicted), left, right)
+    error = np.abs(ref_onsets[nearest] - predicted)
+
+    candidates = np.flatnonzero(error <= tolerance)
+    candidates = candidates[np.argsort(error[candidates], kind="stable")]
+    _, first = np.unique(nearest[candidates], return_index=True)
+    indices = np.sort(candidates[first])
+    return nearest[indices], indices
+
+
+def fit_clocks(
+    ref_times: np.ndarray,
+    times: np.ndarray,
+    groups: np.ndarray,
+    n_groups: Optional[int] = None,
+    fit_drift: bool = True,
+    min_drift_span: float = 600.0,
+) -> Tuple[np.ndarray, float]:
+    """
+    Least-squares fit of `ref_times = offsets[groups] + scale * times`, i.e. one offset per group of times and a clock
+    rate shared by all groups, e.g. for the split recordings of a single device. The drift is only fitted if the times
+    of at least one group span `min_drift_span` seconds, as a rate estimated from closely spaced triggers is dominated
+    by their timing jitter. Otherwise `scale` is fixed to 1.
+
+    Args:
+        ref_times (np.ndarray): Matched trigger times on the reference clock in seconds.
+        times (np.ndarray): Matched trigger times on the clock of the recording in seconds.
+        groups (np.ndarray): Group index of each time.
+        n_groups (Optional[int]): Number of groups, defaults to the highest group index plus one.
+        fit_drift (bool): Whether to fit the relative clock rate or only the offsets.
+        min_drift_span (float): Minimum duration in seconds spanned by the times of a group to fit the drift.
+    Returns:
+        Tuple[np.ndarray, float]: The offset of each group, NaN for groups without times, and the shared scale.
+    """
+    if n_groups is None:
+        n_groups = int(groups.max()) + 1 if len(groups) else 0
+    counts = np.bincount(groups, minlength=n_groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ref_mean = np.bincount(groups, ref_times, n_groups) / counts
+        mean = np.bincount(groups, times, n_groups) / counts
+
+    first, last = np.full(n_groups, np.inf), np.full(n_groups, -np.inf)
+    np.minimum.at(first, groups, times)
+    np.maximum.at(last, groups, times)
+    scale = 1.0
+    if fit_drift and len(times) and (last - first).max() >= min_drift_span:
+        centered = times - mean[groups]
+        scale = float(np.sum(centered * (ref_times - ref_mean[groups])) / np.sum(centered**2))
+    return ref_mean - scale * mean, scale
+
+
+def resample_positions(data: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """
+    Linearly interpolate `data` along its last axis at fractional sample `positions`, e.g. to resample a recording
+    onto the sample times of another clock with `(ref_time - offset) / scale * sfreq`. The positions should lie within
+    the recording, positions outside of it are extrapolated from the first or last two samples.
+
+    Args:
+        data (np.ndarray): Array of shape (..., n_times).
+        positions (np.ndarray): 1D array of fractional sample indices into the last axis of `data`.
+    Returns:
+        np.ndarray: Array of shape (..., len(positions)).
+    """
+    lower = np.clip(np.floor(positions).astype(np.int64), 0, data.shape[-1] - 2)
+    weight = positions - lower
+    return data[..., lower] * (1 - weight) + data[..., lower + 1] * weight
+
+
+def sync_error(residuals: np.ndarray) -> Dict[str, float]:
+    """
+    Summarize the residuals of matched triggers in seconds as the maximum and root mean square error in milliseconds.
+    """
+    residuals = np.asarray(residuals, dtype=float)
+    if len(residuals) == 0:
+        return {"max_error_ms": float("nan"), "rms_error_ms": float("nan")}
+    return {
+        "max_error_ms": float(np.abs(residuals).max() * 1000),
+        "rms_error_ms": float(np.sqrt(np.mean(residuals**2)) * 1000),
+    }
+
+
+def update_sync_report(root: str, entries: Dict[str, Dict[str, Any]], fname: str = SYNC_REPORT_FILE) -> None:
+    """
+    Add or replace the entries of the synchronization report of a derivative, a JSON file in its root that maps each
+    aligned file to its clock model and residual sync error. Other reports keyed by file, such as the merge report of
+    split recordings, are updated in the same way with `fname`.
+    """
+    path = join(root, fname)
+    report = {}
+    if exists(path):
+        with open(path, encoding="utf-8") as f:
+            report = json.load(f)
+    report.update(entries)
+    with replace_file(path) as tmp_path, open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def align_triggers(
+    ref_onsets: np.ndarray,
+    onsets: np.ndarray,
+    tolerance: float = 0.1,
+    max_offset: Optional[float] = None,
+    fit_drift: bool = True,
+    min_drift_span: float = 600.0,
+    max_iter: int = 10,
+) -> Dict[str, Any]:
+    """
+    Align two trains of trigger onsets recorded on different clocks by matching their inter-trigger intervals. The
+    offset supported by the most trigger pairs is taken as the coarse alignment, so missing or additional triggers on
+    either side do not need to be removed by hand. Triggers are then paired one-to-one with the nearest reference
+    trigger and a linear clock model is fitted to the pairs, alternating both until the pairing no longer changes.
+
+    Args:
+        ref_onsets (np.ndarray): Sorted trigger onsets of the reference recording in seconds.
+        onsets (np.ndarray): Sorted trigger onsets of the recording to align in seconds.
+        tolerance (float): Maximum timing error of a matched trigger in seconds.
+        max_offset (Optional[float]): Only consider offsets up to `max_offset` seconds, e.g. if the onsets are already
+            roughly aligned by the measurement dates of the recordings.
+        fit_drift (bool): Whether to fit the relative clock rate of the recordings or only their offset.
+        min_drift_span (float): Minimum duration in seconds spanned by the matched triggers to fit the drift, see
+            `fit_clocks`.
+        max_iter (int): Maximum number of pairing and fitting iterations.
+    Returns:
+        Dict[str, Any]: The clock model `ref_time = offset + scale * time` as `offset` and `scale`, the indices of the
+            matched triggers as `ref_indices` and `indices`, and the `residuals` of the matched triggers in seconds.
+    """
+    ref_onsets = np.asarray(ref_onsets, dtype=float)
+    onsets = np.asarray(onsets, dtype=float)
+    if len(ref_onsets) == 0 or len(onsets) == 0:
+        raise ValueError("Cannot align empty trigger trains")
+
+    offset, scale = _coarse_offset(ref_onsets, onsets, tolerance, max_offset), 1.0
+    ref_indices, indices = _match_nearest(ref_onsets, offset + scale * onsets, tolerance)
+    for _ in range(max_iter):
+        offsets, scale = fit_clocks(
+            ref_onsets[ref_indices], onsets[indices], np.zeros(len(indices), dtype=int), 1, fit_drift, min_drift_span
+        )
+        offset = float(offsets[0])
+        new_ref_indices, new_indices = _match_nearest(ref_onsets, offset + scale * onsets, tolerance)
+        if np.array_equal(new_indices, indices) and np.array_equal(new_ref_indices, ref_indices):
+            break
+        ref_indices, indices = new_ref_indices, new_indices
+
+    return {
+        "offset": offset,
+        "scale": scale,
+        "ref_indices": ref_indices,
+        "indices": indices,
+        "residuals": ref_onsets[ref_indices] - (offset + scale * onsets[indices]),
+    }
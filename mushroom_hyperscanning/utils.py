@@ -1,12 +1,210 @@
+import csv
+import hashlib
+import json
+import os
 import shutil
-from os.path import dirname, exists, join
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from os.path import basename, dirname, exists, join, relpath, splitext
+from pathlib import Path
 from shutil import copytree
-from typing import Callable, List, Optional, Tuple
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 import mne
 import numpy as np
-from joblib import Parallel, delayed
-from tqdm import trange
+from joblib import Parallel, delayed, dump, effective_n_jobs, load
+from numpy.lib.stride_tricks import sliding_window_view
+from tqdm import tqdm
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    import msvcrt
+
+    fcntl = None
+
+MANIFEST_FILE = "manifest.json"
+INDEX_FILE = "eeg_index.json"
+INDEX_LOCK_FILE = INDEX_FILE + ".lock"
+# bookkeeping files of a derivative that are neither copied to the next derivative nor fingerprinted
+UNTRACKED_FILES = (MANIFEST_FILE, INDEX_FILE, INDEX_LOCK_FILE)
+PROFILE_FIELDS = [
+    "name",
+    "step",
+    "subject",
+    "session",
+    "pid",
+    "start",
+    "wall_time",
+    "cpu_time",
+    "peak_rss",
+    "read_bytes",
+    "write_bytes",
+]
+
+# permission bits masked from newly created files, read once as it can only be queried by setting it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# records and open blocks of the active run profile, None if profiling is disabled
+_profile_records: Optional[List[Dict[str, Any]]] = None
+_profile_stack: List[Dict[str, Any]] = []
+
+
+def _window_params(
+    sfreq: float,
+    window_seconds: Optional[float],
+    window_size: Optional[int],
+    step_seconds: Optional[float],
+    step_size: Optional[int],
+) -> Tuple[int, int]:
+    """
+    Resolve window and step sizes in samples from the mutually exclusive seconds/samples arguments.
+    """
+    if window_seconds is not None and window_size is not None:
+        raise ValueError(
+            "Arguments `window_seconds` and `window_size` are mutually exclusive. Please provide only one."
+        )
+    elif window_seconds is not None:
+        window_size = int(window_seconds * sfreq)
+    elif window_size is None:
+        raise ValueError("Either `window_seconds` or `window_size` must be provided.")
+
+    if step_seconds is not None and step_size is not None:
+        raise ValueError("Arguments `step_seconds` and `step_size` are mutually exclusive. Please provide only one.")
+    elif step_seconds is not None:
+        step_size = int(step_seconds * sfreq)
+    elif step_size is None:
+        step_size = window_size
+    return window_size, step_size
+
+
+def window_view(data: np.ndarray, window_size: int, step_size: int, n_windows: Optional[int] = None) -> np.ndarray:
+    """
+    Create a read-only view of sliding windows over the time axis of `data` without copying any samples. Windows start
+    every `step_size` samples, and the last window is dropped if it would end exactly at the end of the data, matching
+    the windows produced by `sliding_window`.
+
+    Args:
+        data (np.ndarray): 2D numpy array of shape (n_channels, n_samples).
+        window_size (int): Size of the sliding window in samples.
+        step_size (int): Step size for the sliding window in samples.
+        n_windows (Optional[int]): Number of windows to return. Defaults to all windows following the convention above.
+    Returns:
+        np.ndarray: Read-only strided view of shape (n_windows, n_channels, window_size).
+    """
+    if n_windows is None:
+        n_windows = len(range(0, data.shape[1] - window_size, step_size))
+    if n_windows == 0:
+        windows = np.empty((0, data.shape[0], window_size), dtype=data.dtype)
+        windows.flags.writeable = False
+        return windows
+    windows = sliding_window_view(data, window_size, axis=1)[:, : n_windows * step_size : step_size]
+    return windows.transpose(1, 0, 2)
+
+
+def _shared_array(data: np.ndarray, folder: str) -> np.ndarray:
+    """
+    Dump `data` into `folder` and reopen it as a read-only memmap. Views of the returned array are sent to joblib
+    workers as references to the file instead of pickled copies.
+    """
+    fname = join(folder, "data.pkl")
+    dump(data, fname)
+    return load(fname, mmap_mode="r")
+
+
+def _apply_to_windows(func: Callable, windows: np.ndarray, sfreq: float) -> List:
+    return [func(window, sfreq) for window in windows]
+
+
+def _channel_picks(raw: mne.io.BaseRaw, include_chans: List[str], exclude_chans: List[str]) -> np.ndarray:
+    """
+    Get the indices of the channels to include or exclude, so the Raw object doesn't need to be copied and picked.
+    """
+    if include_chans:
+        return mne.pick_channels(raw.ch_names, include_chans, ordered=True)
+    missing = [ch for ch in exclude_chans if ch not in raw.ch_names]
+    if missing:
+        raise ValueError(f"Channel(s) {missing} not found, nothing dropped.")
+    return mne.pick_channels(raw.ch_names, [], exclude=exclude_chans)
+
+
+def _block_windows(sfreq: float, block_seconds: float, window_size: int, step_size: int, multiple: int = 1) -> int:
+    """
+    Number of windows per block of roughly `block_seconds`, rounded up to a multiple of `multiple`.
+    """
+    n = max(1, (int(block_seconds * sfreq) - window_size) // step_size + 1)
+    return int(np.ceil(n / multiple)) * multiple
+
+
+def _iter_raw_blocks(
+    raw: mne.io.BaseRaw, picks: np.ndarray, window_size: int, step_size: int, block_windows: int
+) -> Iterator[Tuple[int, int, np.ndarray]]:
+    """
+    Read the data of `raw` in blocks of `block_windows` consecutive windows through `raw.get_data(start, stop)`, so
+    non-preloaded recordings are only decoded one block at a time. Blocks are aligned to the window steps and the
+    samples overlapping with the previous block are carried over instead of being read again. Yields the index of the
+    first window in the block, the number of windows in the block and the block data.
+    """
+    n_windows = len(range(0, raw.n_times - window_size, step_size))
+    carry, carry_start = np.empty((len(picks), 0)), 0
+    for first in range(0, n_windows, block_windows):
+        n = min(block_windows, n_windows - first)
+        start, stop = first * step_size, (first + n - 1) * step_size + window_size
+
+        # keep the samples shared with the previous block and only read the new ones
+        carry = carry[:, start - carry_start :]
+        block = raw.get_data(picks, start=start + carry.shape[1], stop=stop)
+        if carry.shape[1] > 0:
+            block = np.concatenate([carry, block], axis=1)
+        yield first, n, block
+        carry, carry_start = block, start
+
+
+def iter_raw_windows(
+    raw: mne.io.BaseRaw,
+    *,
+    window_seconds: Optional[float] = None,
+    window_size: Optional[int] = None,
+    step_seconds: Optional[float] = None,
+    step_size: Optional[int] = None,
+    include_chans: List[str] = [],
+    exclude_chans: List[str] = [],
+    block_seconds: float = 300.0,
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Lazily iterate over sliding windows of a Raw object. The recording is read from disk in large blocks aligned to the
+    window steps, so a non-preloaded Raw is never loaded as a whole and memory use does not depend on its length.
+
+    Args:
+        raw (mne.io.Raw): MNE Raw object containing EEG data, preloaded or not.
+        window_seconds (Optional[float]): Size of the sliding window in seconds.
+        window_size (Optional[int]): Size of the sliding window in samples. Mutually exclusive with `window_seconds`.
+        step_seconds (Optional[float]): Step size for the sliding window in seconds.
+        step_size (Optional[int]): Step size for the sliding window in samples. Mutually exclusive with `step_seconds`.
+        include_chans (List[str]): List of channel names to include.
+        exclude_chans (List[str]): List of channel names to exclude.
+        block_seconds (float): Approximate duration of the blocks read from disk in seconds.
+    Yields:
+        Tuple[np.ndarray, np.ndarray]: Window onset times and a read-only view of shape (n_windows, n_channels,
+        window_size) with the windows of the current block.
+    """
+    sfreq = raw.info["sfreq"]
+    window_size, step_size = _window_params(sfreq, window_seconds, window_size, step_seconds, step_size)
+    picks = _channel_picks(raw, include_chans, exclude_chans)
+    block_windows = _block_windows(sfreq, block_seconds, window_size, step_size)
+
+    for first, n_windows, block in _iter_raw_blocks(raw, picks, window_size, step_size, block_windows):
+        times = np.arange(first, first + n_windows) * step_size / sfreq
+        yield times, window_view(block, window_size, step_size, n_windows)
 
 
 def sliding_window(
@@ -19,6 +217,7 @@ def sliding_window(
     step_size: Optional[int] = None,
     include_chans: List[str] = [],
     exclude_chans: List[str] = [],
+    block_seconds: float = 300.0,
     n_jobs: int = -1,
     verbose: bool = True,
 ) -> Tuple[np.ndarray, List]:
@@ -26,7 +225,9 @@ def sliding_window(
     Apply a function to chunks of data in a sliding window manner. The provided function should follow the signature
     `func(data: np.ndarray, sfreq: float) -> Any` where `data` is a 2D numpy array of shape (n_channels, n_samples).
     The function will be applied to each chunk of data, and the results will be returned along with the corresponding
-    window onset times.
+    window onset times. Windows are passed as read-only views of the data, and parallel workers receive them through a
+    shared memmap, so the function must not modify its input in place. The data is read block by block (see
+    `iter_raw_windows`), so the Raw object doesn't need to be preloaded.
 
     Args:
         raw (mne.io.Raw): MNE Raw object containing EEG data.
@@ -37,41 +238,37 @@ def sliding_window(
         step_size (Optional[int]): Step size for the sliding window in samples. Mutually exclusive with `step_seconds`.
         include_chans (List[str]): List of channel names to include.
         exclude_chans (List[str]): List of channel names to exclude.
+        block_seconds (float): Approximate duration of the blocks read from disk in seconds.
         n_jobs (int): Number of parallel jobs to run. -1 means using all processors.
         verbose (bool): Whether to print progress messages.
     Returns:
         Tuple[np.ndarray, List]: Window onset times and results returned by the function.
     """
-    raw = raw.copy()
     sfreq = raw.info["sfreq"]
-
-    if window_seconds is not None and window_size is not None:
-        raise ValueError("Arguments `window_seconds` and `window_size` are mutually exclusive. Please provide only one.")
-    elif window_seconds is not None:
-        window_size = int(window_seconds * sfreq)
-    elif window_size is None:
-        raise ValueError("Either `window_seconds` or `window_size` must be provided.")
-
-    if step_seconds is not None and step_size is not None:
-        raise ValueError("Arguments `step_seconds` and `step_size` are mutually exclusive. Please provide only one.")
-    elif step_seconds is not None:
-        step_size = int(step_seconds * sfreq)
-    elif step_size is None:
-        step_size = window_size
-
-    # Select channels to include or exclude
-    if include_chans:
-        raw.pick_channels(include_chans)
-    elif exclude_chans:
-        raw.drop_channels(exclude_chans)
+    window_size, step_size = _window_params(sfreq, window_seconds, window_size, step_seconds, step_size)
+    picks = _channel_picks(raw, include_chans, exclude_chans)
+    block_windows = _block_windows(sfreq, block_seconds, window_size, step_size)
 
     # apply the function to chunks of data
-    data = raw.get_data()
-    times = np.arange(0, len(data[0]) - window_size, step_size) / sfreq
-    results = Parallel(n_jobs=n_jobs)(
-        delayed(func)(data[:, i : i + window_size], sfreq)
-        for i in trange(0, data.shape[1] - window_size, step_size, disable=not verbose)
-    )
+    times = np.arange(0, raw.n_times - window_size, step_size) / sfreq
+    results = []
+    with Parallel(n_jobs=n_jobs, return_as="generator") as parallel, tqdm(
+        total=len(times), disable=not verbose
+    ) as pbar:
+        for _, n_windows, block in _iter_raw_blocks(raw, picks, window_size, step_size, block_windows):
+            with TemporaryDirectory() as folder:
+                # workers receive chunks of windows as views into a shared memmap instead of pickled copies
+                if effective_n_jobs(n_jobs) > 1:
+                    block = _shared_array(block, folder)
+                windows = window_view(block, window_size, step_size, n_windows)
+                chunk_size = max(1, int(np.ceil(n_windows / (effective_n_jobs(n_jobs) * 4))))
+                for chunk in parallel(
+                    delayed(_apply_to_windows)(func, windows[i : i + chunk_size], sfreq)
+                    for i in range(0, n_windows, chunk_size)
+                ):
+                    results.extend(chunk)
+                    pbar.update(len(chunk))
+                del block, windows
 
     # remove None results and corresponding times
     missing = [i for i in range(len(results)) if results[i] is None]
@@ -80,6 +277,82 @@ def sliding_window(
     return times, results
 
 
+def iter_batched_sliding_window(
+    raw: mne.io.Raw,
+    func: Callable,
+    *,
+    window_seconds: Optional[float] = None,
+    window_size: Optional[int] = None,
+    step_seconds: Optional[float] = None,
+    step_size: Optional[int] = None,
+    include_chans: List[str] = [],
+    exclude_chans: List[str] = [],
+    batch_size: int = 100,
+    block_seconds: float = 300.0,
+    n_jobs: int = -1,
+    verbose: bool = True,
+) -> Iterator[Tuple[np.ndarray, List]]:
+    """
+    Streaming version of `batched_sliding_window`. Batches of shape (batch_size, n_channels, n_samples) are taken as
+    read-only views straight from the data buffer, at most `n_jobs` batches are in flight at any time, and the results
+    are yielded batch by batch in order as soon as they are available. The recording is read block by block (see
+    `iter_raw_windows`), so the Raw object doesn't need to be preloaded. The provided function should follow the
+    signature `func(data: np.ndarray, sfreq: float) -> Optional[Sequence]`, returning one result per window or None
+    to skip the whole batch.
+
+    Args:
+        raw (mne.io.Raw): MNE Raw object containing EEG data.
+        func (Callable): Function to apply to each batch of windows.
+        window_seconds (Optional[float]): Size of the sliding window in seconds.
+        window_size (Optional[int]): Size of the sliding window in samples. Mutually exclusive with `window_seconds`.
+        step_seconds (Optional[float]): Step size for the sliding window in seconds.
+        step_size (Optional[int]): Step size for the sliding window in samples. Mutually exclusive with `step_seconds`.
+        include_chans (List[str]): List of channel names to include.
+        exclude_chans (List[str]): List of channel names to exclude.
+        batch_size (int): Number of chunks to process in each batch.
+        block_seconds (float): Approximate duration of the blocks read from disk in seconds.
+        n_jobs (int): Number of parallel jobs to run. -1 means using all processors.
+        verbose (bool): Whether to print progress messages.
+    Yields:
+        Tuple[np.ndarray, List]: Window onset times and results of a single batch, with None results removed.
+    """
+    sfreq = raw.info["sfreq"]
+    window_size, step_size = _window_params(sfreq, window_seconds, window_size, step_seconds, step_size)
+    picks = _channel_picks(raw, include_chans, exclude_chans)
+    # blocks hold a whole number of batches so all batches except the last one have the same size
+    block_windows = _block_windows(sfreq, block_seconds, window_size, step_size, multiple=batch_size)
+
+    times = np.arange(0, raw.n_times - window_size, step_size) / sfreq
+    with Parallel(n_jobs=n_jobs, return_as="generator", pre_dispatch="n_jobs") as parallel, tqdm(
+        total=int(np.ceil(len(times) / batch_size)), disable=not verbose
+    ) as pbar:
+        for first, n_windows, block in _iter_raw_blocks(raw, picks, window_size, step_size, block_windows):
+            with TemporaryDirectory() as folder:
+                # batches are read-only strided views of the data, shared with workers through a memmap
+                if effective_n_jobs(n_jobs) > 1:
+                    block = _shared_array(block, folder)
+                windows = window_view(block, window_size, step_size, n_windows)
+                starts = range(0, n_windows, batch_size)
+                results = parallel(delayed(func)(windows[i : i + batch_size], sfreq) for i in starts)
+                for k, batch_results in enumerate(results):
+                    pbar.update()
+                    i = starts[k]
+                    # ensure all results still have the batch size and expand None results
+                    bs = min(batch_size, n_windows - i)
+                    if batch_results is None:
+                        batch_results = [None] * bs
+                    elif len(batch_results) != bs:
+                        raise ValueError(
+                            f"Function returned {len(batch_results)} results for batch {(first + i) // batch_size}, "
+                            f"expected {bs}. Ensure the function returns a list of results with the same length as the "
+                            "batch size."
+                        )
+                    # remove None results and corresponding times
+                    keep = [j for j, res in enumerate(batch_results) if res is not None]
+                    yield times[first + i : first + i + bs][keep], [batch_results[j] for j in keep]
+                del block, windows
+
+
 def batched_sliding_window(
     raw: mne.io.Raw,
     func: Callable,
@@ -91,6 +364,7 @@ def batched_sliding_window(
     include_chans: List[str] = [],
     exclude_chans: List[str] = [],
     batch_size: int = 100,
+    block_seconds: float = 300.0,
     n_jobs: int = -1,
     verbose: bool = True,
 ) -> Tuple[np.ndarray, List]:
@@ -98,7 +372,9 @@ def batched_sliding_window(
     Apply a function to chunks of data in a sliding window manner, processing the data in batches. The provided function
     should follow the signature `func(data: np.ndarray, sfreq: float) -> Any` where `data` is a 3D numpy array of shape
     (n_batches, n_channels, n_samples). The function will be applied to each chunk of data, and the results will be
-    returned along with the corresponding window onset times.
+    returned along with the corresponding window onset times. Batches are read-only strided views of the data (see
+    `window_view`), so the windows are never stacked into a separate array. Use `iter_batched_sliding_window` to
+    consume the results incrementally instead.
 
     Args:
         raw (mne.io.Raw): MNE Raw object containing EEG data.
@@ -110,62 +386,160 @@ def batched_sliding_window(
         include_chans (List[str]): List of channel names to include.
         exclude_chans (List[str]): List of channel names to exclude.
         batch_size (int): Number of chunks to process in each batch.
+        block_seconds (float): Approximate duration of the blocks read from disk in seconds.
         n_jobs (int): Number of parallel jobs to run. -1 means using all processors.
         verbose (bool): Whether to print progress messages.
     Returns:
         Tuple[np.ndarray, List]: Window onset times and results returned by the function.
     """
-    raw = raw.copy()
-    sfreq = raw.info["sfreq"]
-    times, windows = sliding_window(
+    times, results = [np.empty(0)], []
+    for batch_times, batch_results in iter_batched_sliding_window(
         raw,
-        lambda x, _: x,
+        func,
         window_seconds=window_seconds,
         window_size=window_size,
         step_seconds=step_seconds,
         step_size=step_size,
         include_chans=include_chans,
         exclude_chans=exclude_chans,
-        n_jobs=1,
-        verbose=False,
-    )
+        batch_size=batch_size,
+        block_seconds=block_seconds,
+        n_jobs=n_jobs,
+        verbose=verbose,
+    ):
+        times.append(batch_times)
+        results.extend(batch_results)
+    return np.concatenate(times), results
 
-    windows = np.stack(windows, axis=0)
-    results = Parallel(n_jobs=n_jobs)(
-        delayed(func)(windows[i : i + batch_size], sfreq) for i in trange(0, len(windows), batch_size, disable=not verbose)
-    )
-    # ensure all results still have the batch size and expand None results
-    for i in range(len(results)):
-        bs = len(windows[i * batch_size : (i + 1) * batch_size])
-        if results[i] is None:
-            results[i] = [None] * bs
-        elif len(results[i]) != bs:
-            raise ValueError(
-                f"Function returned {len(results[i])} results for batch {i}, expected {bs}. "
-                "Ensure the function returns a list of results with the same length as the batch size."
-            )
+
+# ioctl request code of FICLONE on Linux, which creates a copy-on-write clone of a file
+FICLONE = 0x40049409
+
+
+def _reflink(src: str, dst: str) -> bool:
+    """
+    Try to create `dst` as a reflink (copy-on-write clone) of `src`, returning whether the filesystem supported it.
+    """
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        if exists(dst):
+            os.remove(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+def clone_file(src: str, dst: str) -> str:
+    """
+    Create `dst` as a reflink (copy-on-write clone) of `src` if the filesystem supports it, and fall back to a regular
+    copy. Either way, `dst` is an independent file, so writing to it never modifies `src`. Follows the `copy_function`
+    protocol of `shutil.copytree`.
+
+    Args:
+        src (str): Path to the source file.
+        dst (str): Path to the file to create.
+    Returns:
+        str: The destination path.
+    """
+    if not _reflink(src, dst):
+        shutil.copy2(src, dst)
+    return dst
+
+
+def link_file(src: str, dst: str) -> str:
+    """
+    Like `clone_file`, but fall back to a hardlink before copying. A hardlinked `dst` shares its inode with `src`, so
+    writing to it in place also modifies `src`, and it must only be written through `replace_file`.
+
+    Args:
+        src (str): Path to the source file.
+        dst (str): Path to the file to create.
+    Returns:
+        str: The destination path.
+    """
+    if _reflink(src, dst):
+        return dst
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+
+@contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    """
+    Context manager holding an exclusive lock on the file at `path`, created if needed, e.g. to serialize the
+    read-modify-write of a file shared by parallel workers. Blocks until the lock is acquired.
+
+    Args:
+        path (str): Path to the lock file.
+    """
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
         else:
-            results[i] = list(results[i])
-    # flatten the results and remove None results
-    results = [item for sublist in results for item in sublist]
-    missing = [i for i in range(len(results)) if results[i] is None]
-    times = np.delete(times, missing)
-    results = [res for i, res in enumerate(results) if i not in missing]
-    return times, results
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def replace_file(path: str) -> Iterator[str]:
+    """
+    Context manager yielding a temporary path next to `path` to write to, which is atomically moved over `path` on exit.
+    Replacing a file instead of overwriting it in place gives it a new inode, so files hardlinked from a previous
+    derivative (see `create_derivative_directory`) are never modified. Steps must write to existing files this way.
+    Every call gets its own temporary file, so processes replacing the same file don't write to each other's.
+
+    Args:
+        path (str): Path to the file to write.
+    Yields:
+        str: Temporary path with the same extension as `path`.
+    """
+    root, ext = splitext(path)
+    fd, tmp_path = tempfile.mkstemp(suffix=f".tmp{ext}", prefix=basename(root) + ".", dir=dirname(path) or ".")
+    os.close(fd)
+    # mkstemp creates the file readable by the owner only, give it the permissions of a regularly created file
+    os.chmod(tmp_path, 0o666 & ~_UMASK)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if exists(tmp_path):
+            os.remove(tmp_path)
 
 
 def create_derivative_directory(
-    derivative_name: str, bids_root: str, previous_derivative: Optional[str] = None, overwrite: bool = False
+    derivative_name: str,
+    bids_root: str,
+    previous_derivative: Optional[str] = None,
+    overwrite: bool = False,
+    link: bool = False,
 ) -> str:
     """
     Copy the BIDS dataset at `source_bids_root` over to the `<bids_root>/../<derivative_name>` folder.
     If `source_bids_root` is None, the base BIDS dataset at `bids_root` will be copied.
+    Files are reflinked where the filesystem supports it (see `clone_file`), so unchanged recordings don't take up disk
+    space again, and copied otherwise. With `link=True`, files that can't be reflinked are hardlinked instead of copied
+    (see `link_file`), so writing to them in place would also modify the previous derivatives and the BIDS dataset.
 
     Args:
         derivative_name (str): Name of the derivative directory to create.
         bids_root (str): Root directory of the BIDS dataset.
         previous_derivative (Optional[str]): Path to the previous derivative to copy from. If None, uses `bids_root`.
         overwrite (bool): Whether to overwrite the existing derivative directory if it exists.
+        link (bool): Whether to hardlink files that can't be reflinked instead of copying them.
     Returns:
         str: Path to the created derivative directory.
     """
@@ -181,7 +555,7 @@ def create_derivative_directory(
         previous_derivative = bids_root
 
     print(
-        f"{'Overwriting' if overwrite else 'Creating'} derivative {derivative_name} at "
+        f"{'Overwriting' if overwrite else 'Creating'} {'hardlinked ' if link else ''}derivative {derivative_name} at "
         f"{join(bids_root, 'derivatives', derivative_name)}...",
         end="",
         flush=True,
@@ -189,13 +563,360 @@ def create_derivative_directory(
     copytree(
         previous_derivative,
         target_dir,
-        ignore=lambda _, n: ["derivatives"] if "derivatives" in n else [],
+        ignore=lambda _, n: [name for name in n if name == "derivatives" or name in UNTRACKED_FILES],
+        copy_function=link_file if link else clone_file,
         dirs_exist_ok=overwrite,
     )
     print("done")
     return target_dir
 
 
+def hash_file(path: str, chunk_size: int = 1 << 24) -> str:
+    """
+    Compute the SHA-1 hash of a file, reading it in chunks.
+
+    Args:
+        path (str): Path to the file.
+        chunk_size (int): Number of bytes to read at once.
+    Returns:
+        str: Hexadecimal SHA-1 digest of the file content.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def cached_decode(path: str, cache_dir: str, name: str, decode: Callable[[str, str], Dict]) -> Tuple[np.ndarray, Dict]:
+    """
+    Decode a file once into a `.npy` array cached in `cache_dir` and return it as a read-only memory map. Entries are
+    keyed by the SHA-1 hash of the file, so copies and links of a file share their entry and modified files are decoded
+    again. Hashes are remembered by path, size and modification time, so unchanged files are not hashed again.
+
+    Args:
+        path (str): Path to the file to decode.
+        cache_dir (str): Directory holding the cached arrays.
+        name (str): Name of the decoded array, distinguishing several arrays decoded from the same file.
+        decode (Callable[[str, str], Dict]): Function decoding the file given as first argument into a `.npy` file at
+            the path given as second argument, and returning JSON serializable metadata.
+    Returns:
+        Tuple[np.ndarray, Dict]: The memory-mapped array and its metadata.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    hashes_file = join(cache_dir, "hashes.json")
+    hashes = {}
+    if exists(hashes_file):
+        with open(hashes_file, "r", encoding="utf-8") as f:
+            hashes = json.load(f)
+
+    key = os.path.realpath(path)
+    stat = os.stat(path)
+    known = hashes.get(key, {})
+    if (known.get("size"), known.get("mtime_ns")) == (stat.st_size, stat.st_mtime_ns):
+        sha1 = known["sha1"]
+    else:
+        sha1 = hash_file(path)
+        hashes[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": sha1}
+        with replace_file(hashes_file) as tmp_path, open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(hashes, f, indent=2)
+
+    fname = join(cache_dir, f"{sha1}-{name}.npy")
+    if not exists(fname):
+        print(f"Decoding {path} into the cache...", end="", flush=True)
+        # the array is written last, its presence marks a complete cache entry
+        with replace_file(fname) as tmp_path:
+            meta = decode(path, tmp_path)
+            with replace_file(fname + ".json") as tmp_meta_path, open(tmp_meta_path, "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+        print("done")
+
+    with open(fname + ".json", "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    return np.load(fname, mmap_mode="r"), meta
+
+
+def hash_directory(root: str, known: Optional[Dict[str, Dict]] = None) -> Dict[str, Dict]:
+    """
+    Fingerprint all files below `root`, skipping `derivatives` directories and derivative bookkeeping files (manifest
+    and EEG index). Files whose size and modification time match an entry in `known` reuse its hash, so unchanged
+    multi-GB recordings are not read again.
+
+    Args:
+        root (str): Root directory to fingerprint.
+        known (Optional[Dict[str, Dict]]): Previously computed fingerprints, as returned by this function.
+    Returns:
+        Dict[str, Dict]: Mapping of POSIX paths relative to `root` to their size, modification time and SHA-1 hash.
+    """
+    known = known or {}
+    fingerprints = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d != "derivatives")
+        for fname in sorted(filenames):
+            if fname in UNTRACKED_FILES:
+                continue
+            path = join(dirpath, fname)
+            key = Path(relpath(path, root)).as_posix()
+            stat = os.stat(path)
+            entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+            if key in known and all(known[key].get(k) == v for k, v in entry.items()):
+                entry["sha1"] = known[key]["sha1"]
+            else:
+                entry["sha1"] = hash_file(path)
+            fingerprints[key] = entry
+    return fingerprints
+
+
+def changed_sessions(old: Dict[str, Dict], new: Dict[str, Dict]) -> Optional[Set[str]]:
+    """
+    Find the sessions (ceremonies) with files that differ between two sets of fingerprints.
+
+    Args:
+        old (Dict[str, Dict]): Fingerprints as returned by `hash_directory`.
+        new (Dict[str, Dict]): Fingerprints as returned by `hash_directory`.
+    Returns:
+        Optional[Set[str]]: Names of the sessions with added, removed or modified files, or None if a file outside of a
+        `ses-*` directory changed.
+    """
+    sessions = set()
+    for key in old.keys() | new.keys():
+        if old.get(key, {}).get("sha1") == new.get(key, {}).get("sha1"):
+            continue
+        ses = [part[len("ses-") :] for part in Path(key).parts if part.startswith("ses-")]
+        if not ses:
+            return None
+        sessions.add(ses[0])
+    return sessions
+
+
+def read_manifest(derivative_dir: str) -> Optional[Dict]:
+    """
+    Read the manifest of a derivative directory.
+
+    Args:
+        derivative_dir (str): Path to the derivative directory.
+    Returns:
+        Optional[Dict]: The manifest, or None if the derivative has no manifest.
+    """
+    path = join(derivative_dir, MANIFEST_FILE)
+    if not exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_manifest(derivative_dir: str, manifest: Dict) -> None:
+    """
+    Write the manifest of a derivative directory.
+
+    Args:
+        derivative_dir (str): Path to the derivative directory.
+        manifest (Dict): Manifest holding the step code hash and the input/output fingerprints.
+    """
+    with replace_file(join(derivative_dir, MANIFEST_FILE)) as tmp_path, open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def _remove_sessions(root: str, names: Set[str]) -> None:
+    """
+    Remove all directories named in `names` (e.g. `ses-ceremony1`) below `root`.
+    """
+    for dirpath, dirnames, _ in os.walk(root):
+        for d in [d for d in dirnames if d in names]:
+            dirnames.remove(d)
+            shutil.rmtree(join(dirpath, d))
+
+
+def drop_sessions(derivative_dir: str, sessions: Set[str]) -> None:
+    """
+    Remove sessions from a derivative, e.g. after a step failed to reprocess them, together with their entries in the
+    manifest. The other sessions and their manifest entries are kept, so the next incremental run finds the dropped
+    sessions out of date and only reprocesses these.
+
+    Args:
+        derivative_dir (str): Path to the derivative directory.
+        sessions (Set[str]): Names of the sessions to drop.
+    """
+    names = {f"ses-{session}" for session in sessions}
+    _remove_sessions(derivative_dir, names)
+
+    manifest = read_manifest(derivative_dir)
+    if manifest is None:
+        return
+    for key in ("inputs", "outputs"):
+        manifest[key] = {
+            path: entry for path, entry in manifest[key].items() if not names.intersection(Path(path).parts)
+        }
+    write_manifest(derivative_dir, manifest)
+
+
+def restore_sessions(source_dir: str, target_dir: str, sessions: Set[str], link: bool = False) -> None:
+    """
+    Replace all `ses-<session>` directories of a derivative with fresh copies from the previous derivative, so a step can
+    reprocess only these sessions.
+
+    Args:
+        source_dir (str): Path to the previous derivative (or BIDS dataset).
+        target_dir (str): Path to the derivative directory to update.
+        sessions (Set[str]): Names of the sessions to restore.
+        link (bool): Whether to hardlink files that can't be reflinked (see `create_derivative_directory`).
+    """
+    names = {f"ses-{session}" for session in sessions}
+    # remove the outdated sessions from the derivative
+    _remove_sessions(target_dir, names)
+
+    # copy the sessions over from the previous derivative
+    for dirpath, dirnames, _ in os.walk(source_dir):
+        dirnames[:] = [d for d in dirnames if d != "derivatives"]
+        for d in [d for d in dirnames if d in names]:
+            dirnames.remove(d)
+            copytree(
+                join(dirpath, d),
+                join(target_dir, relpath(join(dirpath, d), source_dir)),
+                copy_function=link_file if link else clone_file,
+            )
+
+
+def _read_proc(name: str) -> Dict[str, str]:
+    """
+    Parse a `/proc/self/<name>` file made of `key: value` lines, returning an empty dict if it is not available.
+    """
+    try:
+        with open(f"/proc/self/{name}", encoding="utf-8") as f:
+            return dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return {}
+
+
+def _peak_rss() -> Optional[int]:
+    """
+    Peak resident set size of the current process in bytes since the last `_reset_peak_rss`.
+    """
+    status = _read_proc("status")
+    if "VmHWM" in status:
+        return int(status["VmHWM"].split()[0]) * 1024
+    if resource is None:
+        return None
+    # lifetime peak, ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def _reset_peak_rss() -> None:
+    """
+    Reset the peak resident set size of the current process to its current value (Linux only).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="utf-8") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _resource_usage() -> Dict[str, Optional[float]]:
+    """
+    Snapshot of the wall clock, CPU time (including terminated child processes) and I/O counters of this process.
+    """
+    times = os.times()
+    io = _read_proc("io")
+    return {
+        "wall_time": time.perf_counter(),
+        "cpu_time": times.user + times.system + times.children_user + times.children_system,
+        "read_bytes": int(io["rchar"]) if "rchar" in io else None,
+        "write_bytes": int(io["wchar"]) if "wchar" in io else None,
+    }
+
+
+@contextmanager
+def profile(name: str, **tags: str) -> Iterator[None]:
+    """
+    Record the wall time, CPU time, peak RSS and bytes read/written of a block of code into the active run profile (see
+    `run_profile`). Does nothing if no run profile is active. Tags (e.g. `step`, `subject`, `session`) are inherited by
+    the blocks nested in this one. Measurements are inclusive of nested blocks.
+
+    Args:
+        name (str): Name of the profiled block, usually the name of the function.
+        **tags (str): Additional fields to store with the record.
+    """
+    if _profile_records is None:
+        yield
+        return
+
+    # remember the peak of the enclosing block before resetting it for this block
+    parent = _profile_stack[-1] if _profile_stack else None
+    if parent is not None:
+        parent["peak_rss"] = max(parent["peak_rss"] or 0, _peak_rss() or 0)
+    _reset_peak_rss()
+
+    tags = {**(parent["tags"] if parent is not None else {}), **tags}
+    frame = {"tags": tags, "peak_rss": None}
+    _profile_stack.append(frame)
+    start, usage = time.time(), _resource_usage()
+    try:
+        yield
+    finally:
+        end = _resource_usage()
+        _profile_stack.pop()
+        frame["peak_rss"] = max(frame["peak_rss"] or 0, _peak_rss() or 0) or None
+        if parent is not None:
+            parent["peak_rss"] = max(parent["peak_rss"] or 0, frame["peak_rss"] or 0)
+
+        record = {"name": name, **tags, "pid": os.getpid(), "start": start, "peak_rss": frame["peak_rss"]}
+        for key, value in end.items():
+            record[key] = None if value is None or usage[key] is None else value - usage[key]
+        _profile_records.append(record)
+
+
+@contextmanager
+def run_profile() -> Iterator[List[Dict[str, Any]]]:
+    """
+    Activate profiling for the duration of the block. Yields the list the records of all `profile` blocks are added to.
+    """
+    global _profile_records
+    previous, _profile_records = _profile_records, []
+    try:
+        yield _profile_records
+    finally:
+        _profile_records = previous
+
+
+def profiled(func: Callable, *args, **kwargs) -> Tuple[Any, List[Dict[str, Any]]]:
+    """
+    Call `func` in a `profile` block named after it and return its result together with the profile records. This is
+    meant to run in worker processes, the records are then handed to `add_profile_records` in the parent process.
+    """
+    with run_profile() as records, profile(func.__name__):
+        result = func(*args, **kwargs)
+    return result, records
+
+
+def add_profile_records(records: List[Dict[str, Any]], **tags: str) -> None:
+    """
+    Add records collected in another process to the active run profile, filling in the tags of the enclosing block and
+    the additional `tags`.
+    """
+    if _profile_records is None:
+        return
+    tags = {**(_profile_stack[-1]["tags"] if _profile_stack else {}), **tags}
+    _profile_records.extend({**tags, **record} for record in records)
+
+
+def write_profile(path: str, records: List[Dict[str, Any]]) -> None:
+    """
+    Write run profile records to `<path>.json` and `<path>.csv`.
+
+    Args:
+        path (str): Output path without extension.
+        records (List[Dict[str, Any]]): Records collected by `profile` blocks.
+    """
+    with open(f"{path}.json", "w", encoding="utf-8") as f:
+        json.dump(records, f, indent=2)
+    with open(f"{path}.csv", "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=PROFILE_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(records)
+
+
 class PrintBlock:
     """
     A context manager that prints a block of text with a title, indicating the start and end of a process.